@@ -1,4 +1,6 @@
 import os
+import math
+import time
 import tempfile
 from PIL import Image
 
@@ -11,6 +13,31 @@ class Overlay:
         self.logger = logger
         self.tmpdir = tempfile.TemporaryDirectory()
         self.image_path = None
+        self.compositor = None
+        self.widgets = []
+        self.collector = util.Collector(self.logger, self.config.get('collector_workers', 4))
+        self.sampler = util.SystemSampler(self.config.get('sample_interval', 1))
+        self.network = util.NetworkRates(
+            self.sampler,
+            self.config.get('network_interfaces_include'),
+            self.config.get('network_interfaces_exclude'),
+            self.config.get('network_ewma_alpha'),
+        )
+        self.prometheus = None
+        self.skip_unchanged_frames = bool(self.config.get('skip_unchanged_frames', True))
+        self.frame_max_age = float(self.config.get('frame_max_age', 5))
+        self.last_fingerprint = None
+        self.last_frame_time = 0
+        self.jpeg_quality = int(self.config.get('jpeg_quality', 80))
+        self.quality_controller = None
+        self.last_frame_size = 0
+        self.last_frame_packets = 0
+        self.frames_unchanged = util.METRICS.counter('ttlcd_frames_unchanged_total', 'Frames skipped because nothing on screen changed')
+        self.tick_time = util.METRICS.histogram('ttlcd_frame_tick_seconds', 'Time to refresh the widgets of a frame', buckets = util.Histogram.FAST_BUCKETS)
+        self.draw_time = util.METRICS.histogram('ttlcd_frame_draw_seconds', 'Time to draw every widget of a frame', buckets = util.Histogram.FAST_BUCKETS)
+        self.encode_time = util.METRICS.histogram('ttlcd_frame_encode_seconds', 'Time to post process and encode a frame', buckets = util.Histogram.FAST_BUCKETS)
+        self.frame_bytes = util.METRICS.histogram('ttlcd_frame_bytes', 'Size of an encoded frame', buckets = util.Histogram.BYTES_BUCKETS)
+        self.frame_packets = util.METRICS.histogram('ttlcd_frame_packets', 'USB packets of an encoded frame', buckets = util.Histogram.PACKETS_BUCKETS)
 
     def validate_config(self):
         """
@@ -55,6 +82,20 @@ class Overlay:
     def get_image_path(self):
         return(self.image_path)
 
+    def add_widget(self, widget):
+        """
+        Setup a widget and register it to be drawn on every frame.
+        Widgets are drawn in the order they are added.
+        """
+        widget.set_collector(self.collector)
+        widget.set_sampler(self.sampler)
+        widget.set_network(self.network)
+        widget.set_prometheus(self.prometheus)
+        widget.setup(self.get_background())
+        widget.load_font()
+        self.widgets.append(widget)
+        return(widget)
+
     def setup(self):
         # Block execution if configuration is invalid
         if self.validate_config():
@@ -66,12 +107,98 @@ class Overlay:
         # Define where we store our screen jfif
         self.set_image_path(os.path.join(self.tmpdir.name, 'screen.jpg'))
 
-    def display(self, orientation = 0, quality = 80, optimize = False):
-        # Image post processing keeps us safe
-        pp = util.ImagePostProcess(self.image_path)
-        pp.process()
+        # All widgets draw onto a single canvas per frame, the
+        # background is decoded once and reused until it changes
+        self.compositor = util.Compositor(self.get_background())
+        self.compositor.load()
+
+        # Optionally fit every frame into a byte (or packet) budget
+        budget = self.config.get('frame_byte_budget')
+        if budget is None and self.config.get('frame_packet_budget') is not None:
+            budget = int(self.config.get('frame_packet_budget')) * util.IMAGE_PACKET_SIZE
+        if budget is not None:
+            self.quality_controller = util.QualityController(
+                budget,
+                quality = self.config.get('jpeg_quality', 80),
+                min_quality = self.config.get('jpeg_min_quality', 20),
+                max_quality = self.config.get('jpeg_max_quality', 90),
+                step = self.config.get('jpeg_quality_step', 5),
+                hysteresis = self.config.get('jpeg_budget_hysteresis', 0.15),
+                qtables = self.config.get('jpeg_qtables'),
+            )
+
+    def tick(self):
+        # Remote data sources are fetched in the background, starting
+        # once every widget has registered its source
+        if self.collector.ident is None:
+            self.collector.start()
+
+        # Widgets only refresh once their own interval has elapsed
+        now = time.monotonic()
+        for widget in self.widgets:
+            widget.update(now)
+
+        # Re-query everything this frame read past its TTL in one batch
+        if self.prometheus is not None:
+            self.prometheus.revalidate()
+
+    def fingerprint(self):
+        """
+        Identify what the next frame would show from the background in
+        use and the value of every widget after tick().
+        """
+        values = [self.compositor.refresh()]
+        for widget in self.widgets:
+            values.append(repr(widget.get()))
 
-        return(self.image_path)
+        return(hash(tuple(values)))
+
+    def display(self, orientation = 0, quality = None, optimize = False, force = False):
+        """
+        Render and encode the next frame, returns the encoded JPEG.
+        Returns None when nothing on screen changed since the last frame
+        and it is not older than frame_max_age, the caller should then
+        skip sending a frame.
+        """
+        started = time.perf_counter()
+        self.tick()
+        self.tick_time.observe(time.perf_counter() - started)
+
+        fingerprint = self.fingerprint()
+        now = time.monotonic()
+
+        if self.skip_unchanged_frames and not force:
+            if fingerprint == self.last_fingerprint and now - self.last_frame_time < self.frame_max_age:
+                self.frames_unchanged.inc()
+                return(None)
+
+        self.last_fingerprint = fingerprint
+        self.last_frame_time = now
+
+        if quality is None:
+            quality = self.jpeg_quality
+
+        started = time.perf_counter()
+        self.compositor.begin()
+        self.compositor.compose(self.widgets)
+        self.draw_time.observe(time.perf_counter() - started)
+
+        # Image post processing keeps us safe, the frame is only encoded once
+        started = time.perf_counter()
+        frame = self.compositor.encode(orientation = orientation, quality = quality, optimize = optimize, controller = self.quality_controller)
+        self.encode_time.observe(time.perf_counter() - started)
+
+        self.last_frame_size = len(frame)
+        self.last_frame_packets = math.ceil(len(frame) / util.IMAGE_PACKET_SIZE)
+        self.frame_bytes.observe(self.last_frame_size)
+        self.frame_packets.observe(self.last_frame_packets)
+
+        if self.quality_controller is not None:
+            self.logger.debug("frame %d bytes in %d packets at quality %d", self.last_frame_size, self.last_frame_packets, self.quality_controller.last_quality)
+        else:
+            self.logger.debug("frame %d bytes in %d packets", self.last_frame_size, self.last_frame_packets)
+
+        return(frame)
 
     def cleanup(self):
         """
@@ -81,9 +208,11 @@ class Overlay:
 
     def shutdown(self):
         """
-        Override me (required)!
+        Override me (required) and call me once the widgets are shut down!
         """
-        pass
+        if self.prometheus is not None:
+            self.prometheus.shutdown()
+        self.collector.shutdown()
 
 class Kubernetes(Overlay):
     def __init__(self, config, logger):
@@ -155,95 +284,44 @@ class Kubernetes(Overlay):
         if self.validate_config():
             return(True)
 
+        # All Prometheus widgets share one pooled client, unless a
+        # replacement source was handed to us before setup
+        if self.prometheus is None and any(self.config.get(k, False) for k in self.config if k.startswith('enable_prometheus_')):
+            self.prometheus = util.PrometheusClient(
+                self.config.get('prometheus_url'),
+                self.config.get('prometheus_url_disable_ssl'),
+                self.collector,
+                self.logger,
+                self.config.get('prometheus_workers', 4),
+                self.config.get('prometheus_ttl', 15),
+            )
+
         if self.config.get('enable_date', False):
-            self.date = widgets.Date(self.config, self.tmpdir, self.logger)
-            self.date.setup(self.get_background())
+            self.date = self.add_widget(widgets.Date(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_time', False):
-            self.time = widgets.Time(self.config, self.tmpdir, self.logger)
-            self.time.setup(self.get_background())
+            self.time = self.add_widget(widgets.Time(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_kubernetes_pod_count', False):
-            self.pod_count = widgets.KubernetesPodCount(self.config, self.tmpdir, self.logger)
-            self.pod_count.setup(self.get_background())
+            self.pod_count = self.add_widget(widgets.KubernetesPodCount(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_network_throughput_recv', False):
-            self.prometheus_network_throughput_recv = widgets.PrometheusNetworkThroughputRecv(self.config, self.tmpdir, self.logger)
-            self.prometheus_network_throughput_recv.setup(self.get_background())
+            self.prometheus_network_throughput_recv = self.add_widget(widgets.PrometheusNetworkThroughputRecv(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_network_throughput_send', False):
-            self.prometheus_network_throughput_send = widgets.PrometheusNetworkThroughputSend(self.config, self.tmpdir, self.logger)
-            self.prometheus_network_throughput_send.setup(self.get_background())
+            self.prometheus_network_throughput_send = self.add_widget(widgets.PrometheusNetworkThroughputSend(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_oom', False):
-            self.prometheus_oom = widgets.PrometheusOutOfMemory(self.config, self.tmpdir, self.logger)
-            self.prometheus_oom.setup(self.get_background())
+            self.prometheus_oom = self.add_widget(widgets.PrometheusOutOfMemory(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_free_node_memory', False):
-            self.prometheus_free_node_memory = widgets.PrometheusFreeNodeMemory(self.config, self.tmpdir, self.logger)
-            self.prometheus_free_node_memory.setup(self.get_background())
+            self.prometheus_free_node_memory = self.add_widget(widgets.PrometheusFreeNodeMemory(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_free_cpu_percent', False):
-            self.prometheus_free_cpu_percent = widgets.PrometheusFreeCpuPercent(self.config, self.tmpdir, self.logger)
-            self.prometheus_free_cpu_percent.setup(self.get_background())
+            self.prometheus_free_cpu_percent = self.add_widget(widgets.PrometheusFreeCpuPercent(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_prometheus_cluster_disk_throughput', False):
-            self.prometheus_cluster_disk_throughput = widgets.PrometheusClusterDiskThroughput(self.config, self.tmpdir, self.logger)
-            self.prometheus_cluster_disk_throughput.setup(self.get_background())
+            self.prometheus_cluster_disk_throughput = self.add_widget(widgets.PrometheusClusterDiskThroughput(self.config, self.tmpdir, self.logger))
         if self.config.get('text', False):
             for text_config in self.config.get('text', []):
                 if text_config.get('enabled', False):
-                    text_widget = widgets.Text(text_config, self.tmpdir, self.logger)
-                    text_widget.setup(self.get_background())
-                    self.text_widgets.append(text_widget)
+                    self.text_widgets.append(self.add_widget(widgets.Text(text_config, self.tmpdir, self.logger)))
 
         # Success
         return(False)
 
-    def display(self, orientation = 0, quality = 80, optimize = False):
-        # Clear previous frame
-        if self.config.get('enable_date', False):
-            self.date.clear()
-        if self.config.get('enable_time', False):
-            self.time.clear()
-        if self.config.get('enable_kubernetes_pod_count', False):
-            self.pod_count.clear()
-        if self.config.get('enable_prometheus_network_throughput_recv', False):
-            self.prometheus_network_throughput_recv.clear()
-        if self.config.get('enable_prometheus_network_throughput_send', False):
-            self.prometheus_network_throughput_send.clear()
-        if self.config.get('enable_prometheus_oom', False):
-            self.prometheus_oom.clear()
-        if self.config.get('enable_prometheus_free_node_memory', False):
-            self.prometheus_free_node_memory.clear()
-        if self.config.get('enable_prometheus_free_cpu_percent', False):
-            self.prometheus_free_cpu_percent.clear()
-        if self.config.get('enable_prometheus_cluster_disk_throughput', False):
-            self.prometheus_cluster_disk_throughput.clear()
-        if self.config.get('text', False):
-            for text_widget in self.text_widgets:
-                text_widget.clear()
- 
-        # We retrieve a new temporary image path on first draw
-        # It should be utilized in place of get_background in all
-        # further Widgets rendered.
-        if self.config.get('enable_date', False):
-            self.date.draw()
-        if self.config.get('enable_time', False):
-            self.time.draw()
-        if self.config.get('enable_kubernetes_pod_count', False):
-             self.pod_count.draw()
-        if self.config.get('enable_prometheus_network_throughput_recv', False):
-             self.prometheus_network_throughput_recv.draw()
-        if self.config.get('enable_prometheus_network_throughput_send', False):
-             self.prometheus_network_throughput_send.draw()
-        if self.config.get('enable_prometheus_oom', False):
-             self.prometheus_oom.draw()
-        if self.config.get('enable_prometheus_free_node_memory', False):
-             self.prometheus_free_node_memory.draw()
-        if self.config.get('enable_prometheus_free_cpu_percent', False):
-             self.prometheus_free_cpu_percent.draw()
-        if self.config.get('enable_prometheus_cluster_disk_throughput', False):
-             self.prometheus_cluster_disk_throughput.draw()
-        if self.config.get('text', False):
-            for text_widget in self.text_widgets:
-                text_widget.draw()
-
-        got = super().display(orientation = 0, quality = 80, optimize = False)
-        return(self.image_path)
-
     def cleanup(self):
         # We only need to cleanup one of the widgets
         # to ensure the tmpdir has been removed.
@@ -293,6 +371,8 @@ class Kubernetes(Overlay):
             for text_widget in self.text_widgets:
                 text_widget.shutdown()
 
+        super().shutdown()
+
 class Node(Overlay):
     def __init__(self, config, logger):
         self.cpu_utilization = None
@@ -412,135 +492,43 @@ class Node(Overlay):
         super().setup()
 
         if self.config.get('enable_date', False):
-            self.date = widgets.Date(self.config, self.tmpdir, self.logger)
-            self.date.setup(self.get_background())
+            self.date = self.add_widget(widgets.Date(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_time', False):
-            self.time = widgets.Time(self.config, self.tmpdir, self.logger)
-            self.time.setup(self.get_background())
+            self.time = self.add_widget(widgets.Time(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_cpu_utilization', False):
-            self.cpu_utilization = widgets.CpuUtilization(self.config, self.tmpdir, self.logger)
-            self.cpu_utilization.setup(self.get_background())
+            self.cpu_utilization = self.add_widget(widgets.CpuUtilization(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_cpu_utilization_bar', False):
-            self.cpu_utilization_bar = widgets.CpuUtilizationBar(self.config, self.tmpdir, self.logger)
-            self.cpu_utilization_bar.setup(self.get_background())
+            self.cpu_utilization_bar = self.add_widget(widgets.CpuUtilizationBar(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_ram_available', False):
-            self.ram_available = widgets.RamAvailable(self.config, self.tmpdir, self.logger)
-            self.ram_available.setup(self.get_background())
+            self.ram_available = self.add_widget(widgets.RamAvailable(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_ram_utilization', False):
-            self.ram_utilization = widgets.RamUtilization(self.config, self.tmpdir, self.logger)
-            self.ram_utilization.setup(self.get_background())
+            self.ram_utilization = self.add_widget(widgets.RamUtilization(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_ram_utilization_bar', False):
-            self.ram_utilization_bar = widgets.RamUtilizationBar(self.config, self.tmpdir, self.logger)
-            self.ram_utilization_bar.setup(self.get_background())
+            self.ram_utilization_bar = self.add_widget(widgets.RamUtilizationBar(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_loadavg', False):
-            self.loadavg = widgets.LoadAverage(self.config, self.tmpdir, self.logger)
-            self.loadavg.setup(self.get_background())
+            self.loadavg = self.add_widget(widgets.LoadAverage(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_iowait', False):
-            self.iowait = widgets.IOWait(self.config, self.tmpdir, self.logger)
-            self.iowait.setup(self.get_background())
+            self.iowait = self.add_widget(widgets.IOWait(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_network_throughput_send', False):
-            self.network_throughput_send = widgets.NetworkThroughputSend(self.config, self.tmpdir, self.logger)
-            self.network_throughput_send.setup(self.get_background())
+            self.network_throughput_send = self.add_widget(widgets.NetworkThroughputSend(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_network_throughput_recv', False):
-            self.network_throughput_recv = widgets.NetworkThroughputRecv(self.config, self.tmpdir, self.logger)
-            self.network_throughput_recv.setup(self.get_background())
+            self.network_throughput_recv = self.add_widget(widgets.NetworkThroughputRecv(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_network_throughput_send_total', False):
-            self.network_throughput_send_total = widgets.NetworkThroughputSendTotal(self.config, self.tmpdir, self.logger)
-            self.network_throughput_send_total.setup(self.get_background())
+            self.network_throughput_send_total = self.add_widget(widgets.NetworkThroughputSendTotal(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_network_throughput_recv_total', False):
-            self.network_throughput_recv_total = widgets.NetworkThroughputRecvTotal(self.config, self.tmpdir, self.logger)
-            self.network_throughput_recv_total.setup(self.get_background())
+            self.network_throughput_recv_total = self.add_widget(widgets.NetworkThroughputRecvTotal(self.config, self.tmpdir, self.logger))
         if self.config.get('text', False):
             for text_config in self.config.get('text', []):
                 if text_config.get('enabled', False):
-                    text_widget = widgets.Text(text_config, self.tmpdir, self.logger)
-                    text_widget.setup(self.get_background())
-                    self.text_widgets.append(text_widget)
+                    self.text_widgets.append(self.add_widget(widgets.Text(text_config, self.tmpdir, self.logger)))
         if self.config.get('enable_cpufreq', False):
-            self.cpufreq = widgets.CpuFreq(self.config, self.tmpdir, self.logger)
-            self.cpufreq.setup(self.get_background())
+            self.cpufreq = self.add_widget(widgets.CpuFreq(self.config, self.tmpdir, self.logger))
         if self.config.get('enable_uptime', False):
-            self.uptime = widgets.Uptime(self.config, self.tmpdir, self.logger)
-            self.uptime.setup(self.get_background())
+            self.uptime = self.add_widget(widgets.Uptime(self.config, self.tmpdir, self.logger))
 
         # Success
         return(False)
 
-    def display(self, orientation = 0, quality = 80, optimize = False):
-        # Clear previous frame
-        if self.config.get('enable_date', False):
-            self.date.clear()
-        if self.config.get('enable_time', False):
-            self.time.clear()
-        if self.config.get('enable_cpu_utilization', False):
-            self.cpu_utilization.clear()
-        if self.config.get('enable_cpu_utilization_bar', False):
-            self.cpu_utilization_bar.clear()
-        if self.config.get('enable_ram_available', False):
-            self.ram_available.clear()
-        if self.config.get('enable_ram_utilization', False):
-            self.ram_utilization.clear()
-        if self.config.get('enable"ram_utilization_bar', False):
-            self.ram_utilization_bar.clear()
-        if self.config.get('enable_loadavg', False):
-            self.loadavg.clear()
-        if self.config.get('enable_iowait', False):
-            self.iowait.clear()
-        if self.config.get('enable_network_throughput_send', False):
-            self.network_throughput_send.clear()
-        if self.config.get('enable_network_throughput_recv', False):
-            self.network_throughput_recv.clear()
-        if self.config.get('enable_network_throughput_send_total', False):
-            self.network_throughput_send_total.clear()
-        if self.config.get('enable_network_throughput_recv_total', False):
-            self.network_throughput_recv_total.clear()
-        if self.config.get('text', False):
-            for text_widget in self.text_widgets:
-                text_widget.clear()
-        if self.config.get('enable_cpufreq', False):
-            self.cpufreq.clear()
-        if self.config.get('enable_uptime', False):
-            self.uptime.clear()
- 
-        # We retrieve a new temporary image path on first draw
-        # It should be utilized in place of get_background in all
-        # further Widgets rendered.
-        if self.config.get('enable_date', False):
-            self.date.draw()
-        if self.config.get('enable_time', False):
-            self.time.draw()
-        if self.config.get('enable_cpu_utilization', False):
-            self.cpu_utilization.draw()
-        if self.config.get('enable_cpu_utilization_bar', False):
-            self.cpu_utilization_bar.draw()
-        if self.config.get('enable_ram_available', False):
-            self.ram_available.draw()
-        if self.config.get('enable_ram_utilization', False):
-            self.ram_utilization.draw()
-        if self.config.get('enable_ram_utilization_bar', False):
-            self.ram_utilization_bar.draw()
-        if self.config.get('enable_loadavg', False):
-            self.loadavg.draw()
-        if self.config.get('enable_iowait', False):
-            self.iowait.draw()
-        if self.config.get('enable_network_throughput_send', False):
-            self.network_throughput_send.draw()
-        if self.config.get('enable_network_throughput_recv', False):
-            self.network_throughput_recv.draw()
-        if self.config.get('enable_network_throughput_send_total', False):
-            self.network_throughput_send_total.draw()
-        if self.config.get('enable_network_throughput_recv_total', False):
-            self.network_throughput_recv_total.draw()
-        if self.config.get('text', False):
-            for text_widget in self.text_widgets:
-                text_widget.draw()
-        if self.config.get('enable_cpufreq', False):
-            self.cpufreq.draw()
-        if self.config.get('enable_uptime', False):
-            self.uptime.draw()
-
-        return(Overlay.display(self, orientation = 0, quality = 80, optimize = False))
-    
     def cleanup(self):
         # We only need to cleanup one of the widgets
         # to ensure the tmpdir has been removed.
@@ -613,3 +601,5 @@ class Node(Overlay):
             self.cpufreq.shutdown()
         if self.config.get('enable_uptime', False):
             self.uptime.shutdown()
+
+        super().shutdown()
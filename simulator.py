@@ -0,0 +1,235 @@
+import os
+import time
+import array
+import threading
+import collections
+
+import usb.core
+
+# Endpoints in the order LcdController collects them from the two interfaces
+ENDPOINT_COMMAND_OUT = 0
+ENDPOINT_COMMAND_IN = 1
+ENDPOINT_IMAGE_OUT = 2
+ENDPOINT_ACK_IN = 3
+
+# Commands answered with a reply during the handshake
+HANDSHAKE_COMMANDS = (0x85, 0x87, 0x84, 0x81)
+
+COMMAND_SIZE = 440
+ACK_SIZE = 16
+PACKET_SIZE = 1024
+PACKET_HEADER_SIZE = 4
+
+STRING_DESCRIPTORS = {
+    0x01: "Thermaltake",
+    0x02: "LCD Panel",
+    0x03: "00000000",
+}
+
+class SimulatedEndpoint:
+    def __init__(self, device, index):
+        self.device = device
+        self.index = index
+        self.bEndpointAddress = index
+
+    def write(self, data, timeout = None):
+        return(self.device.receive(self.index, data))
+
+    def read(self, buf, timeout = None):
+        return(self.device.send(self.index, buf, timeout))
+
+class SimulatedInterface:
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+
+    def __getitem__(self, index):
+        return(self.endpoints[index])
+
+class SimulatedConfiguration:
+    def __init__(self, device, value = 1):
+        self.device = device
+        self.bConfigurationValue = value
+        self.interfaces = {
+            (0, 0): SimulatedInterface([device.endpoints[ENDPOINT_COMMAND_OUT], device.endpoints[ENDPOINT_COMMAND_IN]]),
+            (1, 0): SimulatedInterface([device.endpoints[ENDPOINT_IMAGE_OUT], device.endpoints[ENDPOINT_ACK_IN]]),
+        }
+
+    def __getitem__(self, index):
+        return(self.interfaces[index])
+
+class SimulatedDevice:
+    """
+    In-process stand-in for the panel's pyusb device.
+
+    Implements the device side of the protocol: string descriptors, a 440
+    byte reply to every handshake command, reassembly of the 0x08 image
+    packets into frames and a 16 byte acknowledgement per frame. Every
+    transfer costs a fixed latency plus its size over the bandwidth, and
+    received frames are optionally written to a directory as JPEGs.
+    """
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.latency = float(config.get('simulate_latency', 0.0002))
+        self.bandwidth = float(config.get('simulate_bandwidth', 0))
+        self.ack_latency = float(config.get('simulate_ack_latency', 0.001))
+        self.ack_drop = int(config.get('simulate_ack_drop', 0) or 0)
+        self.acks_dropped = 0
+        self.dump = config.get('simulate_dump')
+        self.langids = (0x0409,)
+        self.endpoints = [SimulatedEndpoint(self, index) for index in range(4)]
+        self.configuration = SimulatedConfiguration(self)
+        self.replies = {
+            ENDPOINT_COMMAND_IN: collections.deque(),
+            ENDPOINT_ACK_IN: collections.deque(),
+        }
+        self.condition = threading.Condition()
+        self.packets = []
+        self.expected = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.packets_received = 0
+        self.commands = collections.Counter()
+        self.last_frame = None
+
+        if self.dump:
+            os.makedirs(self.dump, exist_ok = True)
+
+        self.logger.info("Simulating panel, latency %.4fs per transfer, bandwidth %s",
+            self.latency, "%d bytes/s" % (self.bandwidth,) if self.bandwidth else "unlimited")
+
+    def transfer(self, size):
+        delay = self.latency
+        if self.bandwidth:
+            delay = delay + size / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_active_configuration(self):
+        return(self.configuration)
+
+    def set_configuration(self, value = None):
+        pass
+
+    def is_kernel_driver_active(self, interface):
+        return(False)
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, data_or_wLength = None, timeout = None):
+        self.transfer(0)
+
+        # GET_DESCRIPTOR for a string, everything else is acknowledged empty
+        if bRequest == 0x06 and wValue >> 8 == 0x03:
+            index = wValue & 0xff
+            if index == 0:
+                data = bytes([4, 0x03]) + self.langids[0].to_bytes(2, 'little')
+            else:
+                text = STRING_DESCRIPTORS.get(index, "").encode('utf-16-le')
+                data = bytes([len(text) + 2, 0x03]) + text
+            return(array.array('B', data[:data_or_wLength]))
+
+        if isinstance(data_or_wLength, int):
+            return(array.array('B'))
+        return(len(data_or_wLength))
+
+    def receive(self, endpoint, data):
+        data = memoryview(data).cast('B')
+        self.transfer(len(data))
+
+        if endpoint == ENDPOINT_COMMAND_OUT:
+            command = data[0]
+            self.commands[command] = self.commands[command] + 1
+            if command in HANDSHAKE_COMMANDS:
+                reply = bytearray(COMMAND_SIZE)
+                reply[0] = command
+                self.reply(ENDPOINT_COMMAND_IN, bytes(reply))
+        elif endpoint == ENDPOINT_IMAGE_OUT:
+            # Whole frame bulk writes carry several packets back to back
+            for offset in range(0, len(data), PACKET_SIZE):
+                self.packet(data[offset:offset + PACKET_SIZE])
+
+        return(len(data))
+
+    def packet(self, packet):
+        self.packets_received = self.packets_received + 1
+
+        if packet[0] != 0x08:
+            self.logger.warning("simulated panel dropped packet with command 0x%02x", packet[0])
+            return
+
+        if packet[3] == 0x80:
+            self.packets = []
+            self.expected = packet[1]
+
+        self.packets.append(bytes(packet[PACKET_HEADER_SIZE:]))
+
+        if self.expected and len(self.packets) == self.expected:
+            self.frame(b''.join(self.packets))
+            self.packets = []
+            self.expected = 0
+
+    def frame(self, data):
+        # Strip the zero padding of the last packet after the JPEG EOI marker
+        end = data.rfind(b'\xff\xd9')
+        if end >= 0:
+            data = data[:end + 2]
+
+        self.frames = self.frames + 1
+        self.frame_bytes = self.frame_bytes + len(data)
+        self.last_frame = data
+
+        if self.dump:
+            with open(os.path.join(self.dump, "frame-%06d.jpg" % (self.frames,)), 'wb') as fd:
+                fd.write(data)
+
+        # Every ack_drop-th frame is never acknowledged, ttlcd has to time out
+        if self.ack_drop and self.frames % self.ack_drop == 0:
+            self.acks_dropped = self.acks_dropped + 1
+            return
+
+        # The panel acknowledges once it decoded the frame
+        self.reply(ENDPOINT_ACK_IN, bytes(ACK_SIZE), self.ack_latency)
+
+    def reply(self, endpoint, data, delay = 0):
+        with self.condition:
+            self.replies[endpoint].append((time.monotonic() + delay, data))
+            self.condition.notify_all()
+
+    def send(self, endpoint, buf, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        queue = self.replies[endpoint]
+
+        with self.condition:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not self.condition.wait_for(lambda: len(queue) > 0, remaining):
+                raise usb.core.USBTimeoutError("Operation timed out", 110, 110)
+
+            # A reply not ready before the deadline stays queued for the next read
+            ready, data = queue[0]
+            late = deadline is not None and ready > deadline
+            if not late:
+                queue.popleft()
+
+        if late:
+            time.sleep(max(deadline - time.monotonic(), 0))
+            raise usb.core.USBTimeoutError("Operation timed out", 110, 110)
+
+        delay = ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.transfer(len(data))
+
+        length = min(len(buf), len(data))
+        buf[:length] = array.array('B', data[:length])
+        return(length)
+
+    def stats(self):
+        return({
+            'frames': self.frames,
+            'bytes': self.frame_bytes,
+            'packets': self.packets_received,
+            'keepalives': self.commands[0x82],
+            'acks_dropped': self.acks_dropped,
+        })
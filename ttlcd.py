@@ -2,37 +2,43 @@ import usb.core
 import usb.util
 import signal
 import daemon
+import array
+import collections
 import struct
 import yaml
 import time
 import math
 import logging
 import argparse
+import json
 import threading
 import os
+import re
 import sys
 
-from PIL import Image
-
 import util
 import layouts
+import widgets
+import simulator
  
-GLOBAL_INIT_LOCK = 0
 MAX_GLOBAL_INIT = 13
 
-GLOBAL_STAT = False
-GLOBAL_RUNNING = False
+GLOBAL_RUNNING = threading.Event()
 
 CLASS_WRITE = "write"
 CLASS_READ = "read"
 CLASS_MAIN = "main"
 CLASS_TRIGGER = "trigger"
 
-IMAGE_PACKET_SIZE = 1020
-IMAGE_CMD_SIZE = 4
+IMAGE_PACKET_SIZE = util.IMAGE_PACKET_SIZE
+IMAGE_CMD_SIZE = util.IMAGE_CMD_SIZE
 
 DESIRED_CONFIG = 1
 
+USB_WRITES = util.METRICS.counter('ttlcd_usb_writes_total', 'USB writes to the panel')
+USB_WRITE_ERRORS = util.METRICS.counter('ttlcd_usb_write_errors_total', 'USB writes to the panel that failed')
+USB_WRITE_TIMEOUTS = util.METRICS.counter('ttlcd_usb_write_timeouts_total', 'USB writes to the panel that timed out')
+
 class USBControl:
 	def __init__(self, dev, logger, endpoint = None):
 		self.device = dev
@@ -57,8 +63,13 @@ class USBControl:
 	def write(self, data = ""):
 		try:
 			self.lock.acquire()
+			USB_WRITES.inc()
 			self.endpoint.write(data)
+		except usb.core.USBTimeoutError:
+			USB_WRITE_TIMEOUTS.inc()
+			self.logger.warning("Timed out sending data for endpoint {}".format(self.endpoint))
 		except:
+			USB_WRITE_ERRORS.inc()
 			self.logger.warning("Failed to send data for endpoint {}".format(self.endpoint))
 		finally:
 			self.lock.release()
@@ -118,6 +129,306 @@ class USBControl:
 
 		return(data)
 
+def load_layout(config, logger):
+	layout = False
+	if config.get('use', False):
+		if str(config.get('use', '')).upper() == "NODE":
+			layout = layouts.Node(config, logger)
+		elif str(config.get('use', '')).upper() == "KUBERNETES":
+			layout = layouts.Kubernetes(config, logger)
+		else:
+			logger.critical("no such layout")	
+	else:
+		logger.critical("missing use selector")
+
+	return(layout)
+
+def load_replay_layout(config, logger, trace):
+	"""
+	Load the configured layout with its widgets fed from a trace instead
+	of psutil, Prometheus and Kubernetes.  The layout is not set up yet.
+	"""
+	config = dict(config)
+
+	# Pod counts come from the trace, not the API server
+	config['kubernetes_pod_count_mode'] = 'replay'
+
+	layout = load_layout(config, logger)
+	if not layout:
+		return(layout)
+
+	layout.sampler = trace
+	layout.network = util.NetworkRates(
+		trace,
+		config.get('network_interfaces_include'),
+		config.get('network_interfaces_exclude'),
+		config.get('network_ewma_alpha'),
+	)
+	layout.prometheus = util.TracePrometheus(trace)
+
+	# A trace only reproduces the data sources it was recorded from
+	if isinstance(layout, layouts.Kubernetes):
+		record = trace.current()
+		if 'prometheus' not in record:
+			logger.warning("trace has no Prometheus results, Prometheus widgets replay as 0")
+		if 'pods' not in record and config.get('enable_kubernetes_pod_count', False):
+			logger.warning("trace has no pod count, the pod count widget replays as 0")
+
+	return(layout)
+
+def record_trace(config, logger, path, count):
+	"""
+	Record a trace of the data sources of the configured layout: system
+	snapshots, the results of every Prometheus query its widgets watch
+	and its pod count.
+	"""
+	config = dict(config)
+
+	# Count pods on demand instead of keeping an informer running
+	config['kubernetes_pod_count_mode'] = 'list'
+
+	layout = load_layout(config, logger)
+	if not layout or layout.setup():
+		return(True)
+
+	pods = None
+	for widget in layout.widgets:
+		if isinstance(widget, widgets.KubernetesPodCount):
+			pods = widget.fetch
+
+	interval = config.get('sample_interval', 1)
+	try:
+		util.Trace.record(layout.sampler, count, interval, layout.prometheus, pods).save(path)
+	finally:
+		layout.cleanup()
+		layout.shutdown()
+
+	return(False)
+
+def publish_trace(layout, trace):
+	for widget in layout.widgets:
+		if widget.remote_key is not None:
+			layout.collector.publish(widget.remote_key, trace.pods())
+
+def load_orientation(config):
+	orientation = config.get('orientation', '').upper()
+
+	if orientation == "BOTTOM":
+		return(util.ROTATE_BOTTOM)
+	elif orientation == "LEFT":
+		return(util.ROTATE_LEFT)
+	elif orientation == "RIGHT":
+		return(util.ROTATE_RIGHT)
+
+	return(util.ROTATE_TOP)
+
+class Handshake:
+	"""
+	Startup exchange with the panel as an explicit sequence of steps.
+
+	Control, Write and Read each own some of the steps.  A thread waits on
+	the condition until the step before its own completed instead of
+	polling, so every step runs as soon as the previous one finished.
+	"""
+	def __init__(self, steps = MAX_GLOBAL_INIT):
+		self.steps = steps
+		self.step = 0
+		self.cancelled = False
+		self.started = time.monotonic()
+		self.completed = None
+		self.condition = threading.Condition()
+
+	def wait(self, step, timeout = None):
+		"""
+		Block until step is reached, False on timeout or cancellation.
+		"""
+		with self.condition:
+			self.condition.wait_for(lambda: self.step >= step or self.cancelled, timeout)
+			return(self.step >= step and not self.cancelled)
+
+	def advance(self):
+		with self.condition:
+			self.step = self.step + 1
+			if self.step == self.steps:
+				self.completed = time.monotonic()
+			self.condition.notify_all()
+			return(self.step)
+
+	def ready(self):
+		"""
+		True between completing the handshake and shutting down.
+		"""
+		return(self.step == self.steps)
+
+	def cancel(self):
+		with self.condition:
+			self.cancelled = True
+			self.condition.notify_all()
+
+GLOBAL_HANDSHAKE = Handshake()
+
+class FrameAck:
+	"""
+	Hands every transmitted frame to Trigger for its 16 byte acknowledgement
+	read and wakes Main up the moment the acknowledgement arrived.
+	"""
+	def __init__(self):
+		self.sequence = 0
+		self.pending = None
+		self.sent_at = None
+		self.timeouts = 0
+		self.finished = False
+		self.latency = util.Histogram()
+		self.condition = threading.Condition()
+
+	def sent(self):
+		with self.condition:
+			self.sequence = self.sequence + 1
+			self.pending = self.sequence
+			self.sent_at = time.monotonic()
+			self.condition.notify_all()
+			return(self.sequence)
+
+	def wait_pending(self, timeout = None, after = None):
+		"""
+		Sequence number of the frame awaiting acknowledgement other than
+		after, or None.
+		"""
+		with self.condition:
+			if self.condition.wait_for(lambda: self.pending is not None and self.pending != after, timeout):
+				return(self.pending)
+			return(None)
+
+	def finish(self):
+		"""
+		No more frames will be sent.
+		"""
+		with self.condition:
+			self.finished = True
+			self.condition.notify_all()
+
+	def wait_finished(self, timeout = None):
+		"""
+		Sequence number of the frame still awaiting acknowledgement once
+		no more frames will be sent, or None.
+		"""
+		with self.condition:
+			self.condition.wait_for(lambda: self.finished, timeout)
+			return(self.pending)
+
+	def acknowledge(self, sequence):
+		with self.condition:
+			# A late acknowledgement must not release a newer frame
+			if self.pending == sequence:
+				self.latency.observe(time.monotonic() - self.sent_at)
+				self.pending = None
+				self.condition.notify_all()
+
+	def wait(self, sequence, timeout = None):
+		"""
+		Block until frame sequence was acknowledged, on timeout give up
+		waiting for it and return False.
+		"""
+		with self.condition:
+			if self.condition.wait_for(lambda: self.pending != sequence, timeout):
+				return(True)
+
+			self.timeouts = self.timeouts + 1
+			self.pending = None
+			return(False)
+
+GLOBAL_ACK = FrameAck()
+
+class Packetizer:
+	"""
+	Split an encoded frame into image packets without intermediate copies.
+
+	Every packet is a reusable, preallocated array with its 4-byte header
+	already in place, frame data is copied into it from a memoryview of the
+	encoded bytes and the remainder of the last packet is zero padded.
+	"""
+	def __init__(self, payload_size = IMAGE_PACKET_SIZE, header_size = IMAGE_CMD_SIZE):
+		self.payload_size = payload_size
+		self.header_size = header_size
+		self.packet_size = payload_size + header_size
+		self.padding = memoryview(bytes(payload_size))
+		self.packets = []
+		self.views = []
+		self.buffer = array.array('B')
+
+	def reserve(self, count):
+		while len(self.packets) < count:
+			index = len(self.packets)
+			packet = array.array('B', bytes(self.packet_size))
+
+			if index == 0:
+				# The packet count of the frame is filled in per frame
+				packet[0:self.header_size] = array.array('B', [0x08, 0x00, 0x00, 0x80])
+			else:
+				packet[0:self.header_size] = array.array('B', [0x08, index, 0x00, 0x00])
+
+			self.packets.append(packet)
+			self.views.append(memoryview(packet))
+
+	def packetize(self, data):
+		view = memoryview(data).cast('B')
+		size = len(view)
+		count = math.ceil(size / self.payload_size)
+
+		self.reserve(count)
+		self.packets[0][1] = count
+
+		start = 0
+		for index in range(count):
+			chunk = view[start:start + self.payload_size]
+			length = len(chunk)
+			packet = self.views[index]
+
+			packet[self.header_size:self.header_size + length] = chunk
+			if length < self.payload_size:
+				packet[self.header_size + length:] = self.padding[:self.payload_size - length]
+
+			start = start + self.payload_size
+
+		return(self.packets[:count])
+
+	def frame(self, data):
+		"""
+		Packetize a frame into one contiguous buffer so it can be sent in a
+		single bulk write, the packets are laid out exactly as packetize()
+		would send them one by one.
+		"""
+		view = memoryview(data).cast('B')
+		size = len(view)
+		count = math.ceil(size / self.payload_size)
+		length = count * self.packet_size
+
+		# Resize in place, no view of the buffer may be held meanwhile
+		if len(self.buffer) > length:
+			del self.buffer[length:]
+		elif len(self.buffer) < length:
+			self.buffer.extend(bytes(length - len(self.buffer)))
+
+		with memoryview(self.buffer) as buffer:
+			start = 0
+			for index in range(count):
+				offset = index * self.packet_size
+				chunk = view[start:start + self.payload_size]
+				end = offset + self.header_size + len(chunk)
+
+				if index == 0:
+					buffer[offset:offset + self.header_size] = bytes([0x08, count, 0x00, 0x80])
+				else:
+					buffer[offset:offset + self.header_size] = bytes([0x08, index, 0x00, 0x00])
+
+				buffer[offset + self.header_size:end] = chunk
+				if end < offset + self.packet_size:
+					buffer[end:offset + self.packet_size] = self.padding[:offset + self.packet_size - end]
+
+				start = start + self.payload_size
+
+		return(self.buffer)
+
 class Write(threading.Thread):
 	def __init__(self, dev, endpoint, config, logger):
 		self.device = dev
@@ -126,6 +437,7 @@ class Write(threading.Thread):
 		self.logger = logger
 		self.classes = {}
 		self.running = False
+		self.stopped = threading.Event()
 		self.logger.info("Loaded Write Driver")
 		threading.Thread.__init__(self)
 	
@@ -133,7 +445,7 @@ class Write(threading.Thread):
 		self.classes[class_index] = cls
 
 	def run(self):
-		global GLOBAL_INIT_LOCK, MAX_GLOBAL_INIT, GLOBAL_RUNNING
+		global GLOBAL_HANDSHAKE, GLOBAL_ACK, GLOBAL_RUNNING
 		self.running = True
 		self.control = USBControl(self.device, self.logger, self.endpoint)
 
@@ -142,42 +454,31 @@ class Write(threading.Thread):
 		self.init()
 
 		while self.running:
-			if GLOBAL_INIT_LOCK >= 13 and GLOBAL_INIT_LOCK < 14 and GLOBAL_RUNNING:
-				time.sleep(2)
+			if GLOBAL_HANDSHAKE.ready() and GLOBAL_RUNNING.is_set():
+				# Keepalive every 2s, shutdown interrupts the wait
+				if self.stopped.wait(2):
+					break
 				pkt = self.control.build(436, 0x82, 0x01, 0x00, 0x80)
 				self.control.write(pkt)
 			else:
-				time.sleep(0.1)
+				self.stopped.wait(0.1)
 
 		self.logger.info("Shutdown Write")
 	
 	def shutdown(self):
 		self.running = False
+		self.stopped.set()
 
 	def init(self):
-		global GLOBAL_INIT_LOCK, MAX_GLOBAL_INIT
-
-		while self.running and GLOBAL_INIT_LOCK < MAX_GLOBAL_INIT:
-			if GLOBAL_INIT_LOCK >= 1 and GLOBAL_INIT_LOCK < 2:
-				self.control.write(self.control.build(436, 0x85, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 3 and GLOBAL_INIT_LOCK < 4:
-				self.control.write(self.control.build(436, 0x87, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 5 and GLOBAL_INIT_LOCK < 6:
-				self.control.write(self.control.build(436, 0x85, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 7 and GLOBAL_INIT_LOCK < 8:
-				self.control.write(self.control.build(436, 0x87, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 9 and GLOBAL_INIT_LOCK < 10:
-				self.control.write(self.control.build(436, 0x84, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 11 and GLOBAL_INIT_LOCK < 12:
-				self.control.write(self.control.build(436, 0x81, 0x01, 0x00, 0x80))
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-
-			time.sleep(0.1)
+		global GLOBAL_HANDSHAKE
+
+		# Write owns the odd steps, Read answers each of them on the next one
+		for step, command in [(1, 0x85), (3, 0x87), (5, 0x85), (7, 0x87), (9, 0x84), (11, 0x81)]:
+			if not self.running or not GLOBAL_HANDSHAKE.wait(step):
+				return
+
+			self.control.write(self.control.build(436, command, 0x01, 0x00, 0x80))
+			GLOBAL_HANDSHAKE.advance()
 		
 	def write(self, packet):
 		self.control.write(packet)
@@ -189,11 +490,11 @@ class Read(threading.Thread):
 		self.config = config
 		self.logger = logger
 		self.running = False
+		self.stopped = threading.Event()
 		self.logger.info("Loaded Read Driver")
 		threading.Thread.__init__(self)
 	
 	def run(self):
-		global GLOBAL_INIT_LOCK, MAX_GLOBAL_INIT, GLOBAL_RUNNING
 		self.running = True
 		self.control = USBControl(self.device, self.logger, self.endpoint)
 
@@ -201,42 +502,128 @@ class Read(threading.Thread):
 
 		self.init()
 
-		while self.running:
-			if GLOBAL_INIT_LOCK >= 15 and GLOBAL_INIT_LOCK < 16 and GLOBAL_RUNNING:
-				time.sleep(2)
-				data = self.control.read(440, 2000)
-			else:
-				time.sleep(0.1)
+		# Nothing is read after the handshake, idle until shutdown
+		self.stopped.wait()
 
 		self.logger.info("Shutdown Read")
 
 	def shutdown(self):
 		self.running = False
+		self.stopped.set()
 
 	def init(self):
-		global GLOBAL_INIT_LOCK, MAX_GLOBAL_INIT
-
-		while self.running and GLOBAL_INIT_LOCK < MAX_GLOBAL_INIT:
-			if GLOBAL_INIT_LOCK >= 2 and GLOBAL_INIT_LOCK < 3:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 4 and GLOBAL_INIT_LOCK < 5:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 6 and GLOBAL_INIT_LOCK < 7:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 8 and GLOBAL_INIT_LOCK < 9:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 10 and GLOBAL_INIT_LOCK < 11:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			if GLOBAL_INIT_LOCK >= 12 and GLOBAL_INIT_LOCK < 13:
-				data = self.control.read(440)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			
-			time.sleep(0.1)
+		global GLOBAL_HANDSHAKE
+
+		# Read owns the even steps, the reply to the command Write just sent
+		for step in [2, 4, 6, 8, 10, 12]:
+			if not self.running or not GLOBAL_HANDSHAKE.wait(step):
+				return
+
+			data = self.control.read(440)
+			GLOBAL_HANDSHAKE.advance()
+
+class FrameQueue:
+	"""
+	Bounded hand-off of encoded frames from Render to Main.
+
+	When the queue is full the oldest frame is dropped, the panel is always
+	sent the freshest frame available.
+	"""
+	def __init__(self, depth = 1):
+		self.frames = collections.deque(maxlen = min(max(int(depth), 1), 2))
+		self.condition = threading.Condition()
+		self.dropped = 0
+
+	def put(self, frame):
+		with self.condition:
+			if len(self.frames) == self.frames.maxlen:
+				self.dropped = self.dropped + 1
+			self.frames.append(frame)
+			self.condition.notify_all()
+
+	def get(self, timeout = None):
+		with self.condition:
+			if not self.condition.wait_for(lambda: len(self.frames) > 0, timeout):
+				return(None)
+
+			frame = self.frames.popleft()
+			self.condition.notify_all()
+
+			return(frame)
+
+	def wait_for_room(self, timeout = None):
+		with self.condition:
+			return(self.condition.wait_for(lambda: len(self.frames) < self.frames.maxlen, timeout))
+
+class Render(threading.Thread):
+	def __init__(self, layout, frames, config, logger):
+		self.layout = layout
+		self.frames = frames
+		self.config = config
+		self.logger = logger
+		self.running = False
+		self.orientate_image = 0
+		self.scheduler = util.FrameScheduler(self.config.get('fps', 10), self.config.get('max_fps'))
+		self.report_interval = self.config.get('frame_report_interval', 60)
+		self.frames_rendered = util.METRICS.counter('ttlcd_frames_rendered_total', 'Frames rendered and queued for sending')
+		util.METRICS.counter('ttlcd_frames_missed_total', 'Frames that started a whole period or more late', function = lambda: self.scheduler.missed)
+		util.METRICS.counter('ttlcd_frames_dropped_total', 'Rendered frames replaced by a fresher one before they were sent', function = lambda: self.frames.dropped)
+		util.METRICS.histogram('ttlcd_frame_render_seconds', 'Time to render and encode a frame', histogram = self.scheduler.frame_time)
+		self.logger.info("Loaded Render Driver")
+		threading.Thread.__init__(self)
+
+	def orientate(self, mode):
+		self.orientate_image = mode
+
+	def run(self):
+		self.running = True
+		last_report = time.monotonic()
+
+		self.logger.info("Render Started")
+
+		while self.running and self.scheduler.wait():
+			try:
+				frame = self.render()
+			except Exception as e:
+				self.logger.error("failed to render frame: %s", str(e))
+				frame = None
+
+			self.scheduler.done()
+
+			if frame is not None:
+				self.frames.put(frame)
+				self.frames_rendered.inc()
+
+				if self.scheduler.period == 0:
+					# Free running, render the next frame as soon as the transmit
+					# side picks this one up or replace it with a fresher one.
+					self.frames.wait_for_room(0.1)
+			elif self.scheduler.period == 0:
+				time.sleep(0.1)
+
+			if self.report_interval and time.monotonic() - last_report >= self.report_interval:
+				self.report()
+				last_report = time.monotonic()
+
+		self.logger.info("Shutdown Render")
+
+	def render(self):
+		# Resizing, rotation and encoding all happen in one final step
+		return(self.layout.display(self.orientate_image))
+
+	def report(self):
+		stats = self.scheduler.stats()
+		self.logger.info("Rendered %d frames, %d missed deadlines, frame time p50 <= %.3fs p99 <= %.3fs, %d frames dropped",
+			stats['frames'], stats['missed'], stats['p50'], stats['p99'], self.frames.dropped)
+
+		if self.layout.prometheus is not None:
+			stats = self.layout.prometheus.stats()
+			self.logger.info("Prometheus cache %d queries, %d hits, %d stale, %d misses, %d refreshes, %d errors, refresh p50 <= %.3fs p99 <= %.3fs",
+				stats['queries'], stats['hits'], stats['stale'], stats['misses'], stats['refreshes'], stats['errors'], stats['p50'], stats['p99'])
+
+	def shutdown(self):
+		self.running = False
+		self.scheduler.stop()
 
 class Main(threading.Thread):
 	def __init__(self, dev, endpoint, config, write_endpoint, logger):
@@ -248,6 +635,14 @@ class Main(threading.Thread):
 		self.running = False
 		self.block = False
 		self.orientate_image = 0
+		self.bulk_transfer = bool(self.config.get('usb_bulk_transfer', False))
+		self.ack_timeout = float(self.config.get('frame_ack_timeout', 3))
+		self.report_interval = self.config.get('frame_report_interval', 60)
+		self.frame_limit = int(self.config.get('frame_limit', 0) or 0)
+		self.transmit = util.METRICS.histogram('ttlcd_frame_transmit_seconds', 'Time to send a frame to the panel', histogram = util.Histogram())
+		self.frames_sent = util.METRICS.counter('ttlcd_frames_sent_total', 'Frames sent to the panel')
+		util.METRICS.histogram('ttlcd_frame_ack_seconds', 'Time until the panel acknowledged a frame', histogram = GLOBAL_ACK.latency)
+		util.METRICS.counter('ttlcd_frame_ack_timeouts_total', 'Frames the panel did not acknowledge in time', function = lambda: GLOBAL_ACK.timeouts)
 		self.logger.info("Loaded Main Driver")
 		threading.Thread.__init__(self)
 	
@@ -261,108 +656,109 @@ class Main(threading.Thread):
 		self.orientate_image = mode
 
 	def run(self):
-		global GLOBAL_INIT_LOCK, GLOBAL_STAT
+		global GLOBAL_HANDSHAKE, GLOBAL_ACK
 		self.running = True
 		self.control = USBControl(self.device, self.logger, self.endpoint)
 
 		first = 0
+		last_report = time.monotonic()
+		packetizer = Packetizer()
 		self.init()
 
 		self.logger.info("Main Started")
 
-		layout = False
-		if self.config.get('use', False):
-			if str(self.config.get('use', '')).upper() == "NODE":
-				layout = layouts.Node(self.config, self.logger)
-			elif str(self.config.get('use', '')).upper() == "KUBERNETES":
-				layout = layouts.Kubernetes(self.config, self.logger)
-			else:
-				self.logger.critical("no such layout")	
-		else:
-			self.logger.critical("missing use selector")
-		
+		layout = load_layout(self.config, self.logger)
+
 		if layout:
 			if not layout.setup():
+				# Frames are rendered ahead on their own thread while we transmit
+				frames = FrameQueue(self.config.get('frame_queue_depth', 1))
+				render = Render(layout, frames, self.config, self.logger)
+				render.orientate(self.orientate_image)
+				render.start()
+
 				while self.running:
 					blocked = False
 
-					if GLOBAL_INIT_LOCK >= 13 and GLOBAL_INIT_LOCK < 14 and not GLOBAL_STAT:
-						if first == 0:
-							self.write_endpoint.write(self.control.build(435, 0x12, 0x01, 0x00, 0x80, 0x64))
-							if first >= 1:
-								first = 2
-							else:
-								first = 1
-
-						image_path = layout.display(self.orientate_image)
-
-						if self.orientate_image > 0:
-							image = Image.open(image_path)
-							rotated_image = image.rotate(self.orientate_image)
-							rotated_image.save(image_path, "JPEG", quality = 80, optimize = True, progressive = False)
-
-						with open(image_path, "rb") as rd:
-							index = 0
-							start = 0
-							pkt_index = 1
-
-							raw_data = rd.read().hex()
-							bbytes = list(map(''.join, zip(*[iter(raw_data)]*2)))
-							bbytes = ['0x' + x for x in bbytes]
-							bbytes = [int(i, 0) for i in bbytes]
-
-							iterations = math.ceil(len(bbytes) / (IMAGE_PACKET_SIZE))
-
-							while index < iterations:
-								packets = []
-								pkt_command = [ 0x08, pkt_index, 0x00, 0x00 ]
-
-								if index == 0:
-									command = [0x08, iterations, 0x00, 0x80]
-									if len(bbytes) > start+IMAGE_PACKET_SIZE:
-										data = command + bbytes[0:start + IMAGE_PACKET_SIZE]
-										packet = self.control.raw_build(0, 0, *data)
-										packets.append(packet)
-									else:
-										data = command + bbytes
-										packet = self.control.raw_build(0, IMAGE_PACKET_SIZE + IMAGE_CMD_SIZE - len(data), *data)
-										packets.append(packet)
-								else:
-									if len(bbytes[start:]) > IMAGE_PACKET_SIZE:
-										data = pkt_command + bbytes[start:start+IMAGE_PACKET_SIZE]
-										packet = self.control.raw_build(0, 0, *data)
-										packets.append(packet)
-									else:
-										data = pkt_command + bbytes[start:]
-										packet = self.control.raw_build(0, IMAGE_PACKET_SIZE + IMAGE_CMD_SIZE - len(data), *data)
-										packets.append(packet)
-
-								for packet in packets:
-									while(self.block):
-										blocked = True
-										time.sleep(0.25)
-
-									if not blocked:
-										self.control.write(packet)
-
-									blocked = False
-
-								if index > 0:
-									pkt_index = pkt_index + 1
-
-								index = index + 1
-								start = start + IMAGE_PACKET_SIZE
-
-						GLOBAL_STAT = True
+					if not GLOBAL_HANDSHAKE.ready():
+						GLOBAL_HANDSHAKE.wait(MAX_GLOBAL_INIT, 0.1)
+						continue
+
+					if first == 0:
+						self.write_endpoint.write(self.control.build(435, 0x12, 0x01, 0x00, 0x80, 0x64))
+						if first >= 1:
+							first = 2
+						else:
+							first = 1
+
+					frame = frames.get(0.1)
+
+					if frame is None:
+						# Nothing changed on screen, keepalives hold the panel meanwhile
+						continue
+
+					started = time.monotonic()
+
+					if self.bulk_transfer:
+						# One write for the whole frame, libusb splits it
+						# into max packet size transfers
+						buffer = packetizer.frame(frame)
+
+						while(self.block):
+							blocked = True
+							time.sleep(0.25)
+
+						if not blocked:
+							self.control.write(buffer)
 					else:
-						time.sleep(0.1)
+						packets = packetizer.packetize(frame)
+
+						for packet in packets:
+							while(self.block):
+								blocked = True
+								time.sleep(0.25)
+
+							if not blocked:
+								self.control.write(packet)
+
+							blocked = False
+
+					if self.transmit.count == 0:
+						self.logger.info("First frame sent %.3fs after start, handshake took %.3fs",
+							time.monotonic() - GLOBAL_HANDSHAKE.started, GLOBAL_HANDSHAKE.completed - GLOBAL_HANDSHAKE.started)
+
+					self.transmit.observe(time.monotonic() - started)
+					self.frames_sent.inc()
+
+					if self.frame_limit and self.transmit.count >= self.frame_limit:
+						self.logger.info("Sent %d frames, stopping", self.transmit.count)
+						self.running = False
+					self.logger.debug("sent %d byte frame in %.4fs", len(frame), time.monotonic() - started)
+
+					if self.report_interval and time.monotonic() - last_report >= self.report_interval:
+						self.report()
+						last_report = time.monotonic()
+
+					# Trigger reads the acknowledgement and wakes us right away
+					sequence = GLOBAL_ACK.sent()
+					if not GLOBAL_ACK.wait(sequence, self.ack_timeout):
+						self.logger.warning("frame was not acknowledged within %.1fs", self.ack_timeout)
+
+				render.shutdown()
+				render.join()
 
 				layout.cleanup()
 				layout.shutdown()
 
 				self.logger.info("Shutdown Main")
-				GLOBAL_STAT = True
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
+				GLOBAL_ACK.finish()
+				GLOBAL_HANDSHAKE.advance()
+
+	def report(self):
+		self.logger.info("Sent %d frames in %s mode, transmit time p50 <= %.3fs p99 <= %.3fs",
+			self.transmit.count, "bulk" if self.bulk_transfer else "packet", self.transmit.quantile(0.5), self.transmit.quantile(0.99))
+		self.logger.info("Frame acknowledgement p50 <= %.3fs p99 <= %.3fs, %d timeouts",
+			GLOBAL_ACK.latency.quantile(0.5), GLOBAL_ACK.latency.quantile(0.99), GLOBAL_ACK.timeouts)
 
 	def shutdown(self):
 		self.running = False
@@ -377,11 +773,12 @@ class Trigger(threading.Thread):
 		self.config = config
 		self.logger = logger
 		self.running = False
+		self.ack_timeout = float(self.config.get('frame_ack_timeout', 3))
 		self.logger.info("Loaded Trigger Driver")
 		threading.Thread.__init__(self)
 	
 	def run(self):
-		global GLOBAL_INIT_LOCK, GLOBAL_STAT, GLOBAL_RUNNING
+		global GLOBAL_HANDSHAKE, GLOBAL_ACK, GLOBAL_RUNNING
 
 		self.logger.info("Trigger Started")
 
@@ -390,20 +787,26 @@ class Trigger(threading.Thread):
 
 		self.init()
 
+		attempted = None
 		while self.running:
-			if GLOBAL_INIT_LOCK >= 13 and GLOBAL_INIT_LOCK < 14 and GLOBAL_STAT:
-				self.control.read(16, 2000)
-				GLOBAL_STAT = False
-				GLOBAL_RUNNING = True
-			time.sleep(0.1)
+			# The timeout only bounds how long shutdown goes unnoticed, a
+			# frame whose acknowledgement read failed is not read again
+			sequence = GLOBAL_ACK.wait_pending(0.5, attempted)
+			if sequence is not None and GLOBAL_HANDSHAKE.ready():
+				attempted = sequence
+				# Main gives up on the frame after frame_ack_timeout, so do we,
+				# an unacknowledged frame then counts as an acknowledgement timeout
+				if self.control.read(16, int(self.ack_timeout * 1000)) is not None:
+					GLOBAL_ACK.acknowledge(sequence)
+					GLOBAL_RUNNING.set()
 		
-		# Break out of main loop and perform confirmation read to try and avoid device lockup
-		while not GLOBAL_STAT:
-			time.sleep(0.1)
+		# Break out of main loop and perform confirmation read to try and avoid device lockup,
+		# only a frame still in flight once Main finished has an acknowledgement to read
+		sequence = GLOBAL_ACK.wait_finished(self.ack_timeout)
 
-		if GLOBAL_INIT_LOCK >= 13 and GLOBAL_INIT_LOCK < 14 and GLOBAL_STAT:
-			self.control.read(16, 1000)
-			GLOBAL_STAT = False
+		if GLOBAL_HANDSHAKE.completed is not None and sequence is not None:
+			if self.control.read(16, int(self.ack_timeout * 1000)) is not None:
+				GLOBAL_ACK.acknowledge(sequence)
 
 		self.logger.info("Shutdown Trigger")
 
@@ -437,23 +840,30 @@ class Control(threading.Thread):
 		self.running = False
 
 	def init(self):
-		global GLOBAL_INIT_LOCK, MAX_GLOBAL_INIT
-
-		while self.running and GLOBAL_INIT_LOCK < MAX_GLOBAL_INIT:
-			if GLOBAL_INIT_LOCK >= 0 and GLOBAL_INIT_LOCK < 1:
-				for index in [0x02, 0x03, 0x02, 0x03, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02]:
-					try:
-						self.control.descriptor(index, 0x0409)	# 0x0409 == English (United States)
-					except usb.core.USBTimeoutError as e:
-						self.control.descriptor(index, 0x0409)	# 0x0409 == English (United States)
-				GLOBAL_INIT_LOCK = GLOBAL_INIT_LOCK + 1
-			time.sleep(0.1)
+		global GLOBAL_HANDSHAKE
+
+		# Control owns the first step, reading the string descriptors
+		if not self.running or not GLOBAL_HANDSHAKE.wait(0):
+			return
+
+		for index in [0x02, 0x03, 0x02, 0x03, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02]:
+			try:
+				self.control.descriptor(index, 0x0409)	# 0x0409 == English (United States)
+			except usb.core.USBTimeoutError as e:
+				self.control.descriptor(index, 0x0409)	# 0x0409 == English (United States)
+		GLOBAL_HANDSHAKE.advance()
 
 class LcdController:
 	def __init__(self, config, logger):
 		self.config = config
 		self.logger = logger
-		self.dev = usb.core.find(idVendor = self.config.get('idVendor'), idProduct = self.config.get('idProduct'))
+		self.simulated = bool(self.config.get('simulate', False))
+		self.metrics = None
+		self.stopped = False
+		if self.simulated:
+			self.dev = simulator.SimulatedDevice(self.config, self.logger)
+		else:
+			self.dev = usb.core.find(idVendor = self.config.get('idVendor'), idProduct = self.config.get('idProduct'))
 		if self.dev is None:
 			raise ValueError('Device not found')
 		
@@ -495,19 +905,13 @@ class LcdController:
 		self.init()
 
 	def init(self):
-		orientation = self.config.get('orientation', '').upper()
-
-		if orientation == "BOTTOM":
-			self.orientation = util.ROTATE_BOTTOM
-		elif orientation == "LEFT":
-			self.orientation = util.ROTATE_LEFT
-		elif orientation == "RIGHT":
-			self.orientation = util.ROTATE_RIGHT
-		else:
-			self.orientation = util.ROTATE_TOP
+		self.orientation = load_orientation(self.config)
 
 	def run(self):
-		global GLOBAL_RUNNING
+		global GLOBAL_HANDSHAKE, GLOBAL_ACK, GLOBAL_RUNNING
+
+		GLOBAL_HANDSHAKE = Handshake()
+		GLOBAL_ACK = FrameAck()
 
 		self.control = Control(self.dev, self.config, self.logger)
 		self.write = Write(self.dev, self.endpoints[0], self.config, self.logger)
@@ -521,6 +925,14 @@ class LcdController:
 
 		self.main.orientate(self.orientation)
 
+		if self.config.get('metrics_listen'):
+			try:
+				self.metrics = util.MetricsServer(self.config.get('metrics_listen'), self.logger)
+				self.metrics.start()
+			except (OSError, ValueError) as e:
+				self.logger.error("Could not serve metrics on %s: %s", self.config.get('metrics_listen'), str(e))
+				self.metrics = None
+
 		self.control.start()
 		self.write.start()
 		self.read.start()
@@ -529,8 +941,9 @@ class LcdController:
 
 		self.logger.info("ttlcd is running")
 
-		while not GLOBAL_RUNNING:
-			time.sleep(0.1)
+		# Running once the panel acknowledged a frame, or Main gave up before
+		while not GLOBAL_RUNNING.wait(0.5) and self.main.is_alive():
+			pass
 
 		# Wait for Main to exit
 		self.main.join()
@@ -544,13 +957,279 @@ class LcdController:
 		self.read.join()
 
 	def shutdown(self):
+		# Called from run() and again on exit or Ctrl-C
+		if self.stopped:
+			return
+		self.stopped = True
+
+		GLOBAL_HANDSHAKE.cancel()
+
 		self.write.shutdown()
 		self.read.shutdown()
 		self.main.shutdown()
 		self.trigger.shutdown()
 		self.control.shutdown()
 
-		usb.util.dispose_resources(self.dev)
+		if self.metrics is not None:
+			self.metrics.shutdown()
+
+		if self.simulated:
+			self.logger.info("Simulated panel received %(frames)d frames, %(bytes)d bytes in %(packets)d packets, %(keepalives)d keepalives, dropped %(acks_dropped)d acknowledgements", self.dev.stats())
+		else:
+			usb.util.dispose_resources(self.dev)
+
+class Bench:
+	"""
+	Runs the real layout pipeline for a number of frames against the
+	simulated panel and reports how long every stage of a frame took.
+
+	Widgets are fed from a trace instead of psutil, Prometheus and
+	Kubernetes, every widget refreshes on every frame and every frame is
+	rendered, so runs of the same trace are comparable.
+	"""
+	STAGES = ['tick', 'draw', 'encode', 'packetize', 'transmit', 'ack']
+
+	def __init__(self, config, logger, trace):
+		self.config = config
+		self.logger = logger
+		self.trace = trace
+		self.bulk_transfer = bool(self.config.get('usb_bulk_transfer', False))
+		self.timings = {stage: [] for stage in self.STAGES}
+		self.frame_times = []
+		self.frame_bytes = []
+		self.frame_packets = []
+
+	def setup(self):
+		self.layout = load_replay_layout(self.config, self.logger, self.trace)
+		if not self.layout:
+			return(True)
+
+		if self.layout.setup():
+			return(True)
+
+		for widget in self.layout.widgets:
+			widget.set_interval(0)
+
+		self.device = simulator.SimulatedDevice(self.config, self.logger)
+		self.image = USBControl(self.device, self.logger, self.device.endpoints[simulator.ENDPOINT_IMAGE_OUT])
+		self.ack = USBControl(self.device, self.logger, self.device.endpoints[simulator.ENDPOINT_ACK_IN])
+		self.packetizer = Packetizer()
+
+		return(False)
+
+	def frame(self, orientation):
+		compositor = self.layout.compositor
+		stamps = [time.perf_counter()]
+
+		self.layout.tick()
+		stamps.append(time.perf_counter())
+
+		compositor.begin()
+		compositor.compose(self.layout.widgets)
+		stamps.append(time.perf_counter())
+
+		frame = compositor.encode(orientation = orientation, quality = self.layout.jpeg_quality, controller = self.layout.quality_controller)
+		stamps.append(time.perf_counter())
+
+		if self.bulk_transfer:
+			packets = [self.packetizer.frame(frame)]
+		else:
+			packets = self.packetizer.packetize(frame)
+		stamps.append(time.perf_counter())
+
+		for packet in packets:
+			self.image.write(packet)
+		stamps.append(time.perf_counter())
+
+		self.ack.read(16, 2000)
+		stamps.append(time.perf_counter())
+
+		for index, stage in enumerate(self.STAGES):
+			self.timings[stage].append(stamps[index + 1] - stamps[index])
+		self.frame_times.append(stamps[-1] - stamps[0])
+		self.frame_bytes.append(len(frame))
+		self.frame_packets.append(math.ceil(len(frame) / IMAGE_PACKET_SIZE))
+
+	def run(self, frames, orientation = 0):
+		started = time.perf_counter()
+
+		for index in range(frames):
+			if index > 0:
+				self.trace.advance()
+			publish_trace(self.layout, self.trace)
+			self.frame(orientation)
+
+		elapsed = time.perf_counter() - started
+
+		self.layout.cleanup()
+		self.layout.shutdown()
+
+		return(self.report(elapsed))
+
+	def summary(self, values):
+		ordered = sorted(values)
+		return({
+			'mean': sum(ordered) / len(ordered),
+			'p50': ordered[int(0.5 * (len(ordered) - 1))],
+			'p99': ordered[int(0.99 * (len(ordered) - 1))],
+			'max': ordered[-1],
+		})
+
+	def report(self, elapsed):
+		return({
+			'layout': self.config.get('use'),
+			'frames': len(self.frame_times),
+			'mode': "bulk" if self.bulk_transfer else "packet",
+			'seconds': elapsed,
+			'fps': len(self.frame_times) / elapsed,
+			'frame_time': self.summary(self.frame_times),
+			'stages': {stage: self.summary(self.timings[stage]) for stage in self.STAGES},
+			'bytes': self.summary(self.frame_bytes),
+			'packets': self.summary(self.frame_packets),
+		})
+
+def setup_tool_logger():
+	# Results go to stdout, keep the log out of the way
+	logger = logging.getLogger('ttlcd')
+	logger.setLevel(logging.WARNING)
+	logger.addHandler(logging.StreamHandler(sys.stderr))
+	return(logger)
+
+def bench(config, args):
+	logger = setup_tool_logger()
+
+	if args.record:
+		if record_trace(config, logger, args.record, args.frames):
+			logger.critical("failed to set up the layout")
+			return(1)
+		return(0)
+
+	if args.trace:
+		trace = util.Trace.load(args.trace)
+	else:
+		trace = util.Trace.synthetic(args.frames, args.seed, config.get('fps', 10) or 10)
+
+	runner = Bench(config, logger, trace)
+	if runner.setup():
+		logger.critical("failed to set up the layout")
+		return(1)
+
+	result = json.dumps(runner.run(args.frames, load_orientation(config)), indent = 2)
+
+	if args.output:
+		with open(args.output, 'w') as fd:
+			fd.write(result + "\n")
+	else:
+		print(result)
+
+	return(0)
+
+class FrameWriter:
+	"""
+	Writes rendered frames to a file.
+
+	A path ending in .mjpeg or .mjpg collects every frame into one Motion
+	JPEG stream, a path with a %d style placeholder writes a numbered
+	sequence and any other path is overwritten by every frame, so it holds
+	the latest one.
+	"""
+	PLACEHOLDER = re.compile(r'%(0?\d*)d')
+
+	def __init__(self, path):
+		self.path = path
+		self.index = 0
+		self.stream = None
+		self.sequence = self.PLACEHOLDER.search(path) is not None
+
+		if os.path.splitext(path)[1].lower() in ('.mjpeg', '.mjpg'):
+			self.stream = open(path, 'wb')
+
+	def write(self, frame):
+		self.index = self.index + 1
+
+		if self.stream is not None:
+			self.stream.write(frame)
+			return(self.path)
+
+		if self.sequence:
+			# Only the placeholder is formatted, any other % is kept as is
+			path = self.PLACEHOLDER.sub(lambda match: ('%' + match.group(1) + 'd') % (self.index,), self.path, count = 1)
+		else:
+			path = self.path
+
+		with open(path, 'wb') as fd:
+			fd.write(frame)
+
+		return(path)
+
+	def close(self):
+		if self.stream is not None:
+			self.stream.close()
+
+def render(config, args):
+	"""
+	Render the configured layout to files without a panel, at the
+	configured frame rate, and print the timing of every frame as a line
+	of JSON.
+	"""
+	logger = setup_tool_logger()
+
+	trace = None
+	if args.trace:
+		trace = util.Trace.load(args.trace)
+		layout = load_replay_layout(config, logger, trace)
+	else:
+		layout = load_layout(config, logger)
+
+	if not layout or layout.setup():
+		logger.critical("failed to set up the layout")
+		return(1)
+
+	fps = config.get('fps', 10) if args.fps is None else args.fps
+	scheduler = util.FrameScheduler(fps, config.get('max_fps'))
+	writer = FrameWriter(args.output or "ttlcd.jpg")
+	orientation = load_orientation(config)
+
+	try:
+		for index in range(args.frames):
+			if not scheduler.wait():
+				break
+
+			if trace is not None:
+				if index > 0:
+					trace.advance()
+				publish_trace(layout, trace)
+
+			tick, draw, encode = layout.tick_time.sum, layout.draw_time.sum, layout.encode_time.sum
+			started = time.perf_counter()
+
+			# Every frame is written, even when nothing on screen changed
+			frame = layout.display(orientation, force = True)
+
+			elapsed = time.perf_counter() - started
+			scheduler.done()
+
+			path = writer.write(frame)
+
+			print(json.dumps({
+				'frame': index + 1,
+				'path': path,
+				'bytes': len(frame),
+				'packets': layout.last_frame_packets,
+				'tick': layout.tick_time.sum - tick,
+				'draw': layout.draw_time.sum - draw,
+				'encode': layout.encode_time.sum - encode,
+				'total': elapsed,
+				'missed': scheduler.missed,
+			}), flush = True)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		writer.close()
+		layout.cleanup()
+		layout.shutdown()
+
+	return(0)
 
 def setup_logger(log_file = False, daemon = False):
 	logger = logging.getLogger('ttlcd')
@@ -581,9 +1260,19 @@ if __name__ == "__main__":
 		epilog = 'Donations are greatly appreciated and can be made at: https://buymeacoffee.com/bekindpleaserewind'
 	)
 
+	parser.add_argument('command', nargs = '?', choices = ['run', 'bench', 'render'], default = 'run', help = 'run drives the panel (default), bench measures the frame pipeline against a simulated panel, render writes frames to files without a panel')
 	parser.add_argument('-c', '--config', action = 'store', dest = 'config', help = 'Configuration file for ttlcd', required = True)
 	parser.add_argument('-l', '--log-file', action = 'store', dest = 'logfile', help = 'Log file for ttlcd', required = False)
 	parser.add_argument('-d', '--daemon', action = 'store_true', dest = 'daemon', help = 'Run as a system daemon', required = False)
+	parser.add_argument('-s', '--simulate', action = 'store_true', dest = 'simulate', help = 'Drive a simulated panel instead of the USB device', required = False)
+	parser.add_argument('--profile', action = 'store', dest = 'profile', type = int, metavar = 'N', help = 'run: profile the pipeline for N frames, then exit', required = False)
+	parser.add_argument('--profile-output', action = 'store', dest = 'profile_output', default = 'ttlcd-profile', help = 'run: file name prefix of the profile and allocation report', required = False)
+	parser.add_argument('--frames', action = 'store', dest = 'frames', type = int, default = 300, help = 'bench, render: number of frames to run (or records to record)', required = False)
+	parser.add_argument('--fps', action = 'store', dest = 'fps', type = float, help = 'render: frames per second, overrides fps of the configuration, 0 renders as fast as possible', required = False)
+	parser.add_argument('--trace', action = 'store', dest = 'trace', help = 'bench, render: replay widget inputs from this trace instead of synthetic (bench) or live (render) ones', required = False)
+	parser.add_argument('--record', action = 'store', dest = 'record', help = 'bench: record a trace of the live system to this file and exit', required = False)
+	parser.add_argument('--seed', action = 'store', dest = 'seed', type = int, default = 0, help = 'bench: seed of the synthetic trace', required = False)
+	parser.add_argument('--output', action = 'store', dest = 'output', help = 'bench: write the JSON report to this file instead of stdout, render: frame file, a numbered sequence with %%d or a .mjpeg stream (default ttlcd.jpg)', required = False)
 	args = parser.parse_args()
 
 	if not args.config or not os.path.exists(args.config):
@@ -594,6 +1283,19 @@ if __name__ == "__main__":
 	with open(args.config, "r") as fd:
 		config = yaml.safe_load(fd.read())
 
+	if args.simulate:
+		config['simulate'] = True
+
+	if args.command == 'bench':
+		sys.exit(bench(config, args))
+
+	if args.command == 'render':
+		sys.exit(render(config, args))
+
+	profiler = None
+	if args.profile:
+		config['frame_limit'] = args.profile
+
 	log_file = False
 	if args.logfile:
 		log_file =  args.logfile
@@ -604,12 +1306,20 @@ if __name__ == "__main__":
 	if config.get('daemon', False) or args.daemon:
 		with daemon.DaemonContext(umask = 0o077, ):
 			logger = setup_logger(log_file, config.get('daemon', False))
+			if args.profile:
+				profiler = util.Profiler(args.profile_output, logger)
+				profiler.start()
 			lcd = LcdController(config, logger)
 			lcd.setup()
 			lcd.run()
 			lcd.shutdown()
+			if profiler is not None:
+				profiler.stop()
 	else:
 		logger = setup_logger(config.get('log_file', False), config.get('daemon', False))
+		if args.profile:
+			profiler = util.Profiler(args.profile_output, logger)
+			profiler.start()
 		try:
 			lcd = LcdController(config, logger)
 			lcd.setup()
@@ -618,5 +1328,9 @@ if __name__ == "__main__":
 		except KeyboardInterrupt:
 			logger.info("Shutting down...")
 			lcd.shutdown()
+
+		if profiler is not None:
+			profiler.stop()
+			print("\n".join(profiler.widgets()))
 		
 	sys.exit(0)
\ No newline at end of file
@@ -1,116 +1,1475 @@
+import io
+import json
+import os
+import sys
+import fnmatch
+import math
+import types
+import random
 import time
 import threading
+import cProfile
+import pstats
+import tracemalloc
+import socketserver
+import http.server
+import concurrent.futures
 import psutil
+import requests
+import urllib3
+import kubernetes
+import prometheus_api_client as prom
 
-from PIL import Image
+from PIL import Image, ImageFont, JpegPresets
 
 ROTATE_TOP = 0
 ROTATE_LEFT = 90
 ROTATE_BOTTOM = 180
 ROTATE_RIGHT = 270
 
-NETWORK_THROUGHPUT = 0
-NETWORK_TOTAL = 1
-
 # Do not adjust image defaults unless you know what you are doing.
 # You run the risk of bricking your device.
 IMAGE_DEFAULT_RESOLUTION = (480, 128)
 IMAGE_DEFAULT_DPI = (300, 300)
 
+# Frames are sent to the device in packets of IMAGE_PACKET_SIZE bytes of
+# image data following an IMAGE_CMD_SIZE byte header.
+IMAGE_PACKET_SIZE = 1020
+IMAGE_CMD_SIZE = 4
+
+# Lossless transpositions for every supported orientation
+ROTATE_TRANSPOSE = {
+    ROTATE_LEFT: Image.Transpose.ROTATE_90,
+    ROTATE_BOTTOM: Image.Transpose.ROTATE_180,
+    ROTATE_RIGHT: Image.Transpose.ROTATE_270,
+}
+
 class ImagePostProcess:
-    def __init__(self, image_path):
+    def __init__(self, image_path = None):
         self.image_path = image_path
     
-    def process(self, orientation = ROTATE_TOP, quality = 80, optimize = False):
-        image = Image.open(self.image_path)
+    def prepare(self, image = None, orientation = ROTATE_TOP):
+        if image is None:
+            image = Image.open(self.image_path)
 
         # We always make sure we have the correct image settings.
         # This is to avoid bricking the lcd (again).
         #   resolution of 480x128
         #   dpi of 300x300
         #   progressive should be disabled
-        image = image.resize(size = IMAGE_DEFAULT_RESOLUTION)
+        if image.size != IMAGE_DEFAULT_RESOLUTION:
+            image = image.resize(size = IMAGE_DEFAULT_RESOLUTION)
 
         # Rotate the specified amount if provided
         if orientation > 0:
-            image = image.rotate(orientation)
+            image = image.transpose(ROTATE_TRANSPOSE[orientation])
+
+            # Quarter turns keep the frame centered within 480x128
+            # just like Image.rotate() without expand did.
+            if image.size != IMAGE_DEFAULT_RESOLUTION:
+                frame = Image.new("RGB", IMAGE_DEFAULT_RESOLUTION)
+                frame.paste(image, (
+                    (IMAGE_DEFAULT_RESOLUTION[0] - image.size[0]) // 2,
+                    (IMAGE_DEFAULT_RESOLUTION[1] - image.size[1]) // 2,
+                ))
+                image = frame
+
+        return(image)
+
+    def encode(self, image, **options):
+        buf = io.BytesIO()
+        image.save(buf, "JPEG", dpi = IMAGE_DEFAULT_DPI, progressive = False, **options)
+        data = buf.getvalue()
+
+        if self.image_path is not None:
+            with open(self.image_path, "wb") as wr:
+                wr.write(data)
+
+        return(data)
+
+    def process(self, image = None, orientation = ROTATE_TOP, quality = 80, optimize = False, controller = None):
+        """
+        Apply the device safety guarantees and encode a frame exactly once.
+        Returns the encoded JPEG, it is also written to image_path if set.
+        A QualityController, if given, picks the encoder settings instead
+        of quality.
+        """
+        image = self.prepare(image, orientation)
+
+        if controller is not None:
+            return(controller.encode(image, self.encode, optimize = optimize))
+
+        return(self.encode(image, quality = quality, optimize = optimize))
+
+# Base luminance and chrominance quantization tables of JPEG Annex K, the
+# tables libjpeg scales by quality
+ANNEX_K_QTABLES = (
+    (16, 11, 10, 16, 24, 40, 51, 61,
+     12, 12, 14, 19, 26, 58, 60, 55,
+     14, 13, 16, 24, 40, 57, 69, 56,
+     14, 17, 22, 29, 51, 87, 80, 62,
+     18, 22, 37, 56, 68, 109, 103, 77,
+     24, 35, 55, 64, 81, 104, 113, 92,
+     49, 64, 78, 87, 103, 121, 120, 101,
+     72, 92, 95, 98, 112, 100, 103, 99),
+    (17, 18, 24, 47, 99, 99, 99, 99,
+     18, 21, 26, 66, 99, 99, 99, 99,
+     24, 26, 56, 99, 99, 99, 99, 99,
+     47, 66, 99, 99, 99, 99, 99, 99,
+     99, 99, 99, 99, 99, 99, 99, 99,
+     99, 99, 99, 99, 99, 99, 99, 99,
+     99, 99, 99, 99, 99, 99, 99, 99,
+     99, 99, 99, 99, 99, 99, 99, 99),
+)
+
+class QualityController:
+    """
+    Picks the JPEG settings of every frame so it fits a byte budget, which
+    bounds the number of packets sent to the device per frame.
+
+    Quality is lowered within a frame until it fits the budget.  It is only
+    raised again after settle consecutive frames came in below the budget
+    by at least the hysteresis fraction, each raise that overshoots doubles
+    that wait so the panel does not flicker between two quality settings.
+
+    Chroma is subsampled 4:2:0 below chroma_quality and kept at 4:4:4
+    above it.  qtables names a PIL.JpegPresets preset whose quantization
+    tables replace the libjpeg defaults.  The presets were made for a
+    fixed quality, so every table is first normalised to the magnitude of
+    its Annex K counterpart: only the preset's shape is kept and quality
+    means the same with and without qtables.
+    """
+    def __init__(self, budget, quality = 80, min_quality = 20, max_quality = 90, step = 5, hysteresis = 0.15, settle = 10, chroma_quality = 90, qtables = None):
+        self.budget = int(budget)
+        self.min_quality = min(max(int(min_quality), 1), 100)
+        self.max_quality = min(max(int(max_quality), self.min_quality), 100)
+        self.quality = min(max(int(quality), self.min_quality), self.max_quality)
+        self.step = max(int(step), 1)
+        self.hysteresis = float(hysteresis)
+        self.settle = max(int(settle), 1)
+        self.chroma_quality = int(chroma_quality)
+        self.base_qtables = None
+        if qtables is not None:
+            self.base_qtables = []
+            for table, base in zip(JpegPresets.presets[qtables]['quantization'], ANNEX_K_QTABLES):
+                table = [int(v) for v in table]
+                ratio = sum(base) / sum(table)
+                self.base_qtables.append([max(v * ratio, 1) for v in table])
+
+        self.wait = self.settle
+        self.below = 0
+        self.raised = False
+        self.frames = 0
+        self.over_budget = 0
+        self.last_size = 0
+        self.last_packets = 0
+        self.last_quality = self.quality
+
+    def options(self, quality):
+        if quality >= self.chroma_quality:
+            subsampling = 0
+        else:
+            subsampling = 2
+
+        if self.base_qtables is None:
+            return({'quality': quality, 'subsampling': subsampling})
+
+        # libjpeg quality scaling of the base tables
+        if quality < 50:
+            scale = 5000 // quality
+        else:
+            scale = 200 - quality * 2
+
+        qtables = []
+        for table in self.base_qtables:
+            qtables.append([min(max(int((v * scale + 50) // 100), 1), 255) for v in table])
+
+        return({'qtables': qtables, 'subsampling': subsampling})
+
+    def encode(self, image, save, optimize = False):
+        quality = self.quality
+        data = save(image, optimize = optimize, **self.options(quality))
+
+        if len(data) > self.budget and self.raised:
+            # The last raise did not fit, wait longer before the next one
+            self.wait = min(self.wait * 2, self.settle * 16)
+        self.raised = False
+
+        while len(data) > self.budget and quality > self.min_quality:
+            quality = max(quality - self.step, self.min_quality)
+            data = save(image, optimize = optimize, **self.options(quality))
+
+        if len(data) > self.budget:
+            self.over_budget = self.over_budget + 1
+
+        if len(data) <= self.budget * (1 - self.hysteresis):
+            self.below = self.below + 1
+        else:
+            self.below = 0
+
+        self.quality = quality
+        if self.below >= self.wait and self.quality < self.max_quality:
+            self.quality = min(self.quality + self.step, self.max_quality)
+            self.below = 0
+            self.raised = True
+
+        self.frames = self.frames + 1
+        self.last_size = len(data)
+        self.last_packets = math.ceil(len(data) / IMAGE_PACKET_SIZE)
+        self.last_quality = quality
+
+        return(data)
+
+    def stats(self):
+        return({
+            'frames': self.frames,
+            'over_budget': self.over_budget,
+            'size': self.last_size,
+            'packets': self.last_packets,
+            'quality': self.last_quality,
+        })
+
+class Compositor:
+    """
+    Every widget of a frame draws onto a single in-memory canvas.
+    The canvas is only encoded once, after the last widget has drawn.
+
+    The background is decoded and resized once and kept as a pristine
+    image, every frame starts from a copy of it.  It is only decoded
+    again when the modification time of the background file changes.
+    """
+    def __init__(self, background_file):
+        self.background_file = background_file
+        self.background = None
+        self.background_mtime = None
+        self.canvas = None
+
+    def load(self):
+        mtime = os.stat(self.background_file).st_mtime_ns
+
+        image = Image.open(self.background_file)
+        image = image.convert("RGB")
+        if image.size != IMAGE_DEFAULT_RESOLUTION:
+            image = image.resize(size = IMAGE_DEFAULT_RESOLUTION)
+
+        self.background = image
+        self.background_mtime = mtime
+
+    def refresh(self):
+        """
+        Reload the background if it changed on disk and return the
+        modification time of the background currently in use.
+        """
+        try:
+            mtime = os.stat(self.background_file).st_mtime_ns
+        except OSError:
+            # Keep the cached background while the file is being replaced
+            mtime = self.background_mtime
+
+        if self.background is None:
+            self.load()
+        elif mtime != self.background_mtime:
+            try:
+                self.load()
+            except OSError:
+                # A partially written background, try again next frame
+                pass
+
+        return(self.background_mtime)
+
+    def begin(self):
+        self.refresh()
+
+        self.canvas = self.background.copy()
+        return(self.canvas)
+
+    def compose(self, widgets):
+        for widget in widgets:
+            started = time.perf_counter()
+            widget.draw(self.canvas)
+            widget.draw_time.observe(time.perf_counter() - started)
+
+    def encode(self, orientation = ROTATE_TOP, quality = 80, optimize = False, controller = None):
+        pp = ImagePostProcess()
+        return(pp.process(self.canvas, orientation = orientation, quality = quality, optimize = optimize, controller = controller))
+
+class FontCache:
+    """
+    Process wide cache of parsed TrueType fonts keyed by (path, size, index).
+    Widgets sharing a font and size share a single ImageFont instance.
+    """
+    def __init__(self):
+        self.fonts = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, font_file, font_size, index = 0):
+        key = (font_file, font_size, index)
+
+        with self.lock:
+            font = self.fonts.get(key)
+            if font is not None:
+                self.hits = self.hits + 1
+                return(font)
+
+            self.misses = self.misses + 1
+            font = ImageFont.truetype(font_file, font_size, index = index)
+            self.fonts[key] = font
+
+        return(font)
+
+    def stats(self):
+        return({
+            'fonts': len(self.fonts),
+            'hits': self.hits,
+            'misses': self.misses,
+        })
+
+    def clear(self):
+        with self.lock:
+            self.fonts = {}
+
+class Histogram:
+    """
+    Cumulative histogram of observations, durations in seconds by default.
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+    BYTES_BUCKETS = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+    PACKETS_BUCKETS = (2, 4, 8, 16, 32, 64, 128)
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            index = 0
+            while index < len(self.buckets) and value > self.buckets[index]:
+                index = index + 1
+
+            self.counts[index] = self.counts[index] + 1
+            self.count = self.count + 1
+            self.sum = self.sum + value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile.
+        """
+        with self.lock:
+            if self.count == 0:
+                return(0)
+
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen = seen + count
+                if seen >= rank:
+                    if index < len(self.buckets):
+                        return(self.buckets[index])
+                    return(float('inf'))
+
+        return(float('inf'))
+
+    def snapshot(self):
+        with self.lock:
+            cumulative = []
+            seen = 0
+            for index, bound in enumerate(self.buckets):
+                seen = seen + self.counts[index]
+                cumulative.append((bound, seen))
+            cumulative.append((float('inf'), self.count))
+
+            return({
+                'buckets': cumulative,
+                'count': self.count,
+                'sum': self.sum,
+            })
+
+class Counter:
+    """
+    Monotonic counter.
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, value = 1):
+        with self.lock:
+            self.value = self.value + value
+
+    def get(self):
+        return(self.value)
+
+class Metrics:
+    """
+    Registry of the counters and histograms exposed by the metrics
+    endpoint, in the Prometheus text format.
+
+    A metric is either a Counter or Histogram owned by the registry, an
+    existing Histogram registered as is, or a function returning the
+    current value of a count kept elsewhere; functions are only called
+    when the endpoint is scraped.  Registering the same name and labels
+    again returns the existing metric, or replaces a registered one.
+    """
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def family(self, name, kind, help):
+        family = self.families.get(name)
+        if family is None:
+            family = {'kind': kind, 'help': help, 'metrics': {}}
+            self.families[name] = family
+        return(family)
+
+    def counter(self, name, help, labels = None, function = None):
+        key = tuple(sorted((labels or {}).items()))
+
+        with self.lock:
+            metrics = self.family(name, 'counter', help)['metrics']
+            if function is not None:
+                metrics[key] = function
+            elif key not in metrics:
+                metrics[key] = Counter()
+            return(metrics[key])
+
+    def histogram(self, name, help, labels = None, buckets = Histogram.DEFAULT_BUCKETS, histogram = None):
+        key = tuple(sorted((labels or {}).items()))
+
+        with self.lock:
+            metrics = self.family(name, 'histogram', help)['metrics']
+            if histogram is not None:
+                metrics[key] = histogram
+            elif key not in metrics:
+                metrics[key] = Histogram(buckets)
+            return(metrics[key])
+
+    def collect(self, name):
+        """
+        Returns the labels and metric of every series of a metric.
+        """
+        with self.lock:
+            family = self.families.get(name, {'metrics': {}})
+            return([(dict(key), metric) for key, metric in family['metrics'].items()])
+
+    def labels(self, key, extra = ()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return("")
+
+        escaped = []
+        for label, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append('%s="%s"' % (label, value))
+
+        return("{" + ",".join(escaped) + "}")
+
+    def number(self, value):
+        if value == float('inf'):
+            return("+Inf")
+        return(repr(float(value)) if isinstance(value, float) else str(value))
+
+    def render(self):
+        with self.lock:
+            families = [(name, dict(family, metrics = dict(family['metrics']))) for name, family in sorted(self.families.items())]
+
+        lines = []
+        for name, family in families:
+            lines.append("# HELP %s %s" % (name, family['help']))
+            lines.append("# TYPE %s %s" % (name, family['kind']))
+
+            for key, metric in sorted(family['metrics'].items()):
+                if family['kind'] == 'histogram':
+                    snapshot = metric.snapshot()
+                    for bound, count in snapshot['buckets']:
+                        lines.append("%s_bucket%s %d" % (name, self.labels(key, [('le', self.number(bound))]), count))
+                    lines.append("%s_sum%s %s" % (name, self.labels(key), self.number(snapshot['sum'])))
+                    lines.append("%s_count%s %d" % (name, self.labels(key), snapshot['count']))
+                else:
+                    try:
+                        value = metric.get() if isinstance(metric, Counter) else metric()
+                    except Exception:
+                        continue
+                    lines.append("%s%s %s" % (name, self.labels(key), self.number(value)))
+
+        return("\n".join(lines) + "\n")
+
+# Metrics of the whole process, served by MetricsServer
+METRICS = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        if isinstance(self.client_address, tuple):
+            return(self.client_address[0])
+        return("unix")
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("metrics %s %s", self.address_string(), format % args)
+
+class MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class MetricsUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer(threading.Thread):
+    """
+    Serves a metrics registry in the Prometheus text format.
+
+    listen is either host:port or unix:<path> for a Unix socket.
+    """
+    def __init__(self, listen, logger, metrics = METRICS):
+        self.listen = str(listen)
+        self.logger = logger
+        self.path = None
+
+        if self.listen.startswith('unix:'):
+            self.path = self.listen[len('unix:'):]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = MetricsUnixServer(self.path, MetricsHandler)
+        else:
+            host, _, port = self.listen.rpartition(':')
+            self.server = MetricsHTTPServer((host.strip('[]') or '127.0.0.1', int(port)), MetricsHandler)
+
+        self.server.metrics = metrics
+        self.server.logger = logger
+
+        threading.Thread.__init__(self, name = "ttlcd-metrics", daemon = True)
+
+    def run(self):
+        self.logger.info("Serving metrics on %s", self.listen)
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+class Profiler:
+    """
+    Profiles every thread of the process with cProfile and traces
+    allocations with tracemalloc.
+
+    Before Python 3.12 profiles are per thread, so threads started after
+    start() each get their own profile.  From 3.12 on cProfile uses
+    sys.monitoring and a single profile sees every thread.  stop() merges
+    the profiles into a single pstats file next to a report of the top
+    allocations and the time every widget class spent in tick() and draw().
+    """
+    def __init__(self, output, logger, top = 25):
+        self.output = output
+        self.logger = logger
+        self.top = top
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def enable(self, *args):
+        # Enabling the profile replaces this hook on the calling thread
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            sys.setprofile(None)
+            self.logger.warning("Could not profile thread %s, another profiler is active", threading.current_thread().name)
+            return
+
+        with self.lock:
+            self.profiles.append((threading.current_thread(), profile))
+
+    def start(self):
+        tracemalloc.start(10)
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.enable)
+        self.enable()
+
+    def stop(self, timeout = 5):
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        with self.lock:
+            threads = list(self.profiles)
+
+        profiles = []
+        deadline = time.monotonic() + timeout
+        for thread, profile in threads:
+            if thread is threading.current_thread():
+                profile.disable()
+            else:
+                # Only read a profile once its thread stopped writing to it
+                thread.join(max(deadline - time.monotonic(), 0))
+                if thread.is_alive():
+                    self.logger.warning("Thread %s is still running, leaving it out of the profile", thread.name)
+                    continue
+            profiles.append(profile)
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.output + ".pstats")
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+        lines = ["Time per widget class", ""]
+        lines.extend(self.widgets())
+        lines.extend(["", "Top %d allocations" % (self.top,), ""])
+        for statistic in snapshot.statistics('lineno')[:self.top]:
+            lines.append(str(statistic))
+
+        with open(self.output + ".txt", "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+
+        self.logger.info("Profiled %d threads, wrote %s.pstats and %s.txt", len(profiles), self.output, self.output)
+
+    def widgets(self, metrics = METRICS):
+        times = {}
+        for kind in ('tick', 'draw'):
+            for labels, histogram in metrics.collect('ttlcd_widget_%s_seconds' % (kind,)):
+                times.setdefault(labels['widget'], {})[kind] = histogram.snapshot()
+
+        empty = {'count': 0, 'sum': 0}
+        rows = []
+        for widget, kinds in times.items():
+            tick = kinds.get('tick', empty)
+            draw = kinds.get('draw', empty)
+            rows.append((tick['sum'] + draw['sum'], widget, tick, draw))
+        rows.sort(reverse = True)
+
+        lines = ["%-36s %8s %10s %9s %8s %10s %9s" % ("widget", "ticks", "tick ms", "mean ms", "draws", "draw ms", "mean ms")]
+        for total, widget, tick, draw in rows:
+            lines.append("%-36s %8d %10.2f %9.3f %8d %10.2f %9.3f" % (
+                widget,
+                tick['count'], tick['sum'] * 1000, tick['sum'] * 1000 / max(tick['count'], 1),
+                draw['count'], draw['sum'] * 1000, draw['sum'] * 1000 / max(draw['count'], 1),
+            ))
+
+        return(lines)
+
+class FrameScheduler:
+    """
+    Paces frames to a target rate on monotonic deadlines.
+
+    fps is the target frame rate and max_fps caps it, the lower of both
+    wins.  With neither set (or 0) frames are free running.  A frame that
+    starts a whole period or more after its deadline counts as a missed
+    deadline and the schedule is re-anchored instead of bursting to catch up.
+    """
+    def __init__(self, fps = None, max_fps = None):
+        rates = [float(r) for r in (fps, max_fps) if r]
+        if rates:
+            self.period = 1.0 / min(rates)
+        else:
+            self.period = 0
+
+        self.deadline = None
+        self.started = None
+        self.frames = 0
+        self.missed = 0
+        self.frame_time = Histogram()
+        self.stopped = threading.Event()
+
+    def wait(self):
+        """
+        Block until the next frame is due.  Returns False once stopped.
+        """
+        now = time.monotonic()
+
+        if self.deadline is None:
+            self.deadline = now
+
+        delay = self.deadline - now
+        if delay > 0:
+            if self.stopped.wait(delay):
+                return(False)
+        elif self.period > 0 and -delay >= self.period:
+            self.missed = self.missed + 1
+            self.deadline = now
+
+        self.started = time.monotonic()
+        self.deadline = self.deadline + self.period
+
+        return(not self.stopped.is_set())
+
+    def done(self):
+        """
+        Record the time the frame started by wait() took.
+        """
+        if self.started is not None:
+            self.frame_time.observe(time.monotonic() - self.started)
+            self.frames = self.frames + 1
+            self.started = None
 
-        image.save(self.image_path, "JPEG", quality = quality, optimize = optimize, dpi = IMAGE_DEFAULT_DPI, progressive = False)
+    def stop(self):
+        self.stopped.set()
 
-class NetworkStatistics(threading.Thread):
-    def __init__(self, cmd, interval = 1):
-        self.cmd = cmd
-        self.interval = interval
-        self.last_throughput = False
-        self.last_total = False
+    def stats(self):
+        return({
+            'frames': self.frames,
+            'missed': self.missed,
+            'p50': self.frame_time.quantile(0.5),
+            'p99': self.frame_time.quantile(0.99),
+            'histogram': self.frame_time.snapshot(),
+        })
+
+class Collector(threading.Thread):
+    """
+    Runs the blocking fetches of remote data sources concurrently in the
+    background and publishes each latest result into a snapshot.
+
+    Readers only ever look at the snapshot, so frame latency does not depend
+    on remote round-trips.  Every registered fetch runs once per interval on
+    a worker pool, a fetch still in flight is never started twice.
+    """
+    def __init__(self, logger, workers = 4):
+        self.logger = logger
+        self.workers = max(int(workers), 1)
+        self.jobs = {}
+        self.snapshot = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.executor = None
         self.running = False
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon = True)
+
+    def register(self, key, fetch, interval):
+        with self.lock:
+            self.jobs[key] = {
+                'fetch': fetch,
+                'interval': max(float(interval), 0.1),
+                'due': 0,
+                'busy': False,
+            }
+        self.wakeup.set()
+
+    def unregister(self, key):
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def get(self, key, default = None):
+        with self.lock:
+            return(self.snapshot.get(key, default))
 
-    def poll_throughput(self):
-        return(self.last_throughput)
+    def version(self, key):
+        """
+        Monotonic time the current result for key was published at.
+        """
+        with self.lock:
+            return(self.versions.get(key))
 
-    def poll_total(self):
-        return(self.last_total)
+    def publish(self, key, value):
+        with self.lock:
+            self.snapshot[key] = value
+            self.versions[key] = time.monotonic()
+
+    def submit(self, fn, *args):
+        """
+        Run a one-off task on the worker pool.
+        """
+        if self.executor is None:
+            return(None)
+        return(self.executor.submit(fn, *args))
 
     def run(self):
         self.running = True
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "ttlcd-collector")
 
         while self.running:
-            if self.cmd == NETWORK_THROUGHPUT:
-                self.last_throughput = self.throughput()
-            elif self.cmd == NETWORK_TOTAL:
-                self.last_total = self.total()
-                time.sleep(0.1)
+            self.wakeup.clear()
+            now = time.monotonic()
+            wait = 1.0
+
+            with self.lock:
+                for key, job in self.jobs.items():
+                    if job['busy']:
+                        continue
+                    if job['due'] <= now:
+                        job['busy'] = True
+                        self.executor.submit(self.fetch, key, job)
+                    else:
+                        wait = min(wait, job['due'] - now)
+
+            self.wakeup.wait(wait)
+
+        self.executor.shutdown(wait = False, cancel_futures = True)
+
+    def fetch(self, key, job):
+        try:
+            self.publish(key, job['fetch']())
+        except Exception as e:
+            self.logger.warning("failed to collect %s: %s", key, str(e))
+        finally:
+            with self.lock:
+                job['busy'] = False
+                job['due'] = time.monotonic() + job['interval']
+            self.wakeup.set()
 
     def shutdown(self):
         self.running = False
+        self.wakeup.set()
+
+class PrometheusClient:
+    """
+    One pooled connection to a Prometheus server, shared by every widget
+    of a layout, with a result cache keyed by PromQL.
+
+    Widgets register their PromQL with watch(), identical queries share a
+    single cache entry. get() never blocks: it returns the cached result
+    even once it outlived its TTL and queues the query for revalidation.
+    revalidate() runs once per frame and evaluates every queued query
+    concurrently in the background against one evaluation timestamp, so
+    the values of a frame are consistent with each other.
+    """
+    def __init__(self, url, disable_ssl, collector, logger, workers = 4, ttl = 15):
+        self.url = url
+        self.collector = collector
+        self.logger = logger
+        self.workers = max(int(workers), 1)
+        self.ttl = max(float(ttl), 0.1)
+        self.cache = {}
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "ttlcd-prometheus")
+        # Same retries as prometheus-api-client applies by default
+        retry = urllib3.util.retry.Retry(total = 3, backoff_factor = 1, status_forcelist = [408, 429, 500, 502, 503, 504])
+
+        session = requests.Session()
+        session.verify = not disable_ssl
+        self.pclient = prom.PrometheusConnect(url = url, disable_ssl = disable_ssl, retry = retry, session = session)
+
+        # Keep one keep-alive connection per concurrent query.  The client
+        # mounts its own adapter on url, the longer api prefix takes
+        # precedence for every query.
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = self.workers, max_retries = retry)
+        session.mount(url.rstrip('/') + '/api/', adapter)
+
+        for result, attribute in (('hit', 'hits'), ('stale', 'stale'), ('miss', 'misses')):
+            METRICS.counter('ttlcd_prometheus_cache_lookups_total', 'Prometheus cache lookups by widgets', {'result': result}, lambda attribute = attribute: getattr(self, attribute))
+        METRICS.counter('ttlcd_prometheus_refreshes_total', 'Prometheus queries evaluated', function = lambda: self.refreshes)
+        METRICS.counter('ttlcd_prometheus_errors_total', 'Prometheus queries that failed', function = lambda: self.errors)
+        METRICS.histogram('ttlcd_prometheus_refresh_seconds', 'Time to evaluate a batch of Prometheus queries', histogram = self.latency)
+
+    def watch(self, query, ttl = None):
+        """
+        Cache the results of query for ttl seconds, the shortest ttl wins
+        when several widgets watch the same query.
+        """
+        ttl = self.ttl if ttl is None else max(float(ttl), 0.1)
+
+        with self.lock:
+            if query in self.cache:
+                self.cache[query]['ttl'] = min(self.cache[query]['ttl'], ttl)
+            else:
+                self.cache[query] = {
+                    'value': None,
+                    'ttl': ttl,
+                    'expires': 0,
+                    'wanted': False,
+                    'refreshing': False,
+                }
+
+    def get(self, query, default = None):
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.cache[query]
+            if entry['value'] is None:
+                self.misses = self.misses + 1
+            elif entry['expires'] > now:
+                self.hits = self.hits + 1
+            else:
+                self.stale = self.stale + 1
+
+            if entry['expires'] <= now and not entry['refreshing']:
+                entry['wanted'] = True
+
+            if entry['value'] is None:
+                return(default)
+            return(entry['value'])
+
+    def queries(self):
+        with self.lock:
+            return(list(self.cache.keys()))
+
+    def snapshot(self):
+        """
+        The cached result of every query that has one.
+        """
+        with self.lock:
+            return({query: entry['value'] for query, entry in self.cache.items() if entry['value'] is not None})
+
+    def revalidate(self):
+        """
+        Refresh every query read while expired in the background.
+        """
+        with self.lock:
+            queries = [query for query, entry in self.cache.items() if entry['wanted']]
+            for query in queries:
+                self.cache[query]['wanted'] = False
+                self.cache[query]['refreshing'] = True
+
+        if not queries:
+            return(None)
+
+        future = self.collector.submit(self.refresh, queries)
+        if future is None:
+            # Collector not running yet, try again next frame
+            with self.lock:
+                for query in queries:
+                    self.cache[query]['wanted'] = True
+                    self.cache[query]['refreshing'] = False
+
+        return(future)
+
+    def refresh(self, queries):
+        started = time.monotonic()
+        params = {'time': time.time()}
 
-    def throughput(self):
-        before = psutil.net_io_counters()
-        time.sleep(self.interval)
-        after = psutil.net_io_counters()
+        futures = {
+            query: self.executor.submit(self.pclient.custom_query, query = query, params = params)
+            for query in queries
+        }
 
-        recv_bps = round(after.bytes_recv - before.bytes_recv, 2)
-        recv_kbps = round(recv_bps / 1024, 2)
-        recv_mbps = round(recv_bps / 1024 / 1024, 2)
+        for query, future in futures.items():
+            value = None
+            try:
+                value = future.result()
+            except Exception as e:
+                self.logger.warning("failed to query prometheus for %s: %s", query, str(e))
 
-        sent_bps = round(after.bytes_sent - before.bytes_sent, 2)
-        sent_kbps = round(sent_bps / 1024, 2)
-        sent_mbps = round(sent_bps / 1024 / 1024, 2)
+            with self.lock:
+                entry = self.cache[query]
+                entry['refreshing'] = False
+                # Results age from their evaluation time so a batch expires
+                # together, failed queries keep serving the last result
+                entry['expires'] = started + entry['ttl']
+                if value is None:
+                    self.errors = self.errors + 1
+                else:
+                    entry['value'] = value
+                    self.refreshes = self.refreshes + 1
 
+        # One observation per batch, the batch is done once its slowest query is
+        self.latency.observe(time.monotonic() - started)
+
+    def stats(self):
+        with self.lock:
+            return({
+                'queries': len(self.cache),
+                'hits': self.hits,
+                'stale': self.stale,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+                'p50': self.latency.quantile(0.5),
+                'p99': self.latency.quantile(0.99),
+            })
+
+    def shutdown(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+
+# Ask the API server for pod metadata only instead of full pod objects
+POD_METADATA_LIST = 'application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io,application/json'
+POD_METADATA_WATCH = 'application/json;as=PartialObjectMetadata;v=v1;g=meta.k8s.io,application/json'
+
+def list_pods(client, field_selector = None, label_selector = None, limit = 500):
+    """
+    Return the metadata of every pod matching the server-side selectors
+    and the resourceVersion of the list, fetched limit pods per page.
+    """
+    pods = []
+    resource_version = None
+    token = None
+
+    while True:
+        kwargs = {}
+        if field_selector:
+            kwargs['field_selector'] = field_selector
+        if label_selector:
+            kwargs['label_selector'] = label_selector
+        if token:
+            kwargs['_continue'] = token
+
+        r = client.list_pod_for_all_namespaces(
+            limit = int(limit),
+            _preload_content = False,
+            _headers = {'Accept': POD_METADATA_LIST},
+            **kwargs
+        )
+        data = json.loads(r.data)
+
+        pods.extend(item.get('metadata', {}) for item in data.get('items', []))
+
+        metadata = data.get('metadata', {})
+        # Every page is served from the snapshot of the first one
+        if resource_version is None:
+            resource_version = metadata.get('resourceVersion')
+
+        token = metadata.get('continue')
+        if not token:
+            return(pods, resource_version)
+
+class PodInformer(threading.Thread):
+    """
+    Keeps an in-memory index of the cluster's pods up to date.
+
+    Pods are listed once, after that a watch stream started from the list's
+    resourceVersion applies every change, with bookmarks keeping the
+    resourceVersion current through quiet periods. When the
+    resourceVersion expired (410 Gone) the pods are listed again, any
+    other failure reconnects with exponential backoff. The pod count is
+    published into the collector snapshot under key whenever it changes.
+    """
+    def __init__(self, client, collector, key, logger, field_selector = None, label_selector = None, limit = 500, timeout = 300, backoff = 1, max_backoff = 60):
+        self.client = client
+        self.field_selector = field_selector
+        self.label_selector = label_selector
+        self.limit = limit
+        self.collector = collector
+        self.key = key
+        self.logger = logger
+        self.timeout = int(timeout)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.pods = set()
+        self.resource_version = None
+        self.stream = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        threading.Thread.__init__(self, daemon = True)
+
+    def count(self):
+        with self.lock:
+            return(len(self.pods))
+
+    def publish(self):
+        self.collector.publish(self.key, self.count())
+
+    def relist(self):
+        pods, resource_version = list_pods(self.client, self.field_selector, self.label_selector, self.limit)
+
+        with self.lock:
+            self.pods = set(pod.get('uid') for pod in pods)
+            self.resource_version = resource_version
+
+        self.publish()
+
+    def watch(self):
+        self.stream = kubernetes.watch.Watch()
+
+        kwargs = {}
+        if self.field_selector:
+            kwargs['field_selector'] = self.field_selector
+        if self.label_selector:
+            kwargs['label_selector'] = self.label_selector
+
+        for event in self.stream.stream(
+            self.client.list_pod_for_all_namespaces,
+            resource_version = self.resource_version,
+            allow_watch_bookmarks = True,
+            timeout_seconds = self.timeout,
+            _request_timeout = self.timeout + 30,
+            _headers = {'Accept': POD_METADATA_WATCH},
+            **kwargs
+        ):
+            raw = event.get('raw_object') or {}
+            metadata = raw.get('metadata') if isinstance(raw, dict) else None
+
+            if event.get('type') == 'ERROR' or not metadata:
+                # Our index may have missed changes, back off and list again
+                self.resource_version = None
+                self.stream.stop()
+                raise ValueError("unexpected %s pod watch event" % (event.get('type'),))
+
+            if event['type'] != 'BOOKMARK':
+                with self.lock:
+                    before = len(self.pods)
+                    if event['type'] == 'DELETED':
+                        self.pods.discard(metadata.get('uid'))
+                    else:
+                        self.pods.add(metadata.get('uid'))
+                    changed = len(self.pods) != before
+
+                if changed:
+                    self.publish()
+
+            self.resource_version = metadata.get('resourceVersion', self.resource_version)
+
+            if self.stopped.is_set():
+                self.stream.stop()
+
+    def run(self):
+        delay = self.backoff
+
+        while not self.stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch()
+                delay = self.backoff
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status == 410:
+                    self.logger.debug("pod watch expired, listing pods again")
+                    self.resource_version = None
+                    continue
+
+                self.logger.warning("failed to watch pods: %s", str(e))
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+            except Exception as e:
+                self.logger.warning("failed to watch pods: %s", str(e))
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.stream is not None:
+            self.stream.stop()
+
+class SystemSampler:
+    """
+    Takes one coherent snapshot of the local system per sampling period.
+
+    All widgets of a frame read from the same snapshot, so their numbers
+    come from the same instant and every psutil call is only made once
+    per period no matter how many widgets show its result.
+    """
+    def __init__(self, interval = 1):
+        self.interval = float(interval)
+        self.last = None
+        self.taken = -math.inf
+        self.lock = threading.Lock()
+
+        # cpu_percent() compares against the previous call, prime it
+        psutil.cpu_percent()
+
+    def sample(self):
         return({
-            'recv': {
-                'bps': recv_bps,
-                'kbps': recv_kbps,
-                'mbps': recv_mbps,
-            },
-            'send': {
-                'bps': sent_bps,
-                'kbps': sent_kbps,
-                'mbps': sent_mbps,
-            }
+            'time': time.monotonic(),
+            'cpu_percent': psutil.cpu_percent(),
+            'cpu_times': psutil.cpu_times(),
+            'cpu_freq': psutil.cpu_freq(),
+            'memory': psutil.virtual_memory(),
+            'loadavg': psutil.getloadavg(),
+            'net': psutil.net_io_counters(pernic = True),
         })
 
-    def total(self):
-        data = psutil.net_io_counters()
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.taken >= self.interval:
+                self.last = self.sample()
+                self.taken = now
 
-        recv_bps = data.bytes_recv
-        recv_kbps = recv_bps / 1024
-        recv_mbps = recv_bps / 1024 / 1024
+            return(self.last)
 
-        sent_bps = data.bytes_sent
-        sent_kbps = sent_bps / 1024
-        sent_mbps = sent_bps / 1024 / 1024
+class Trace:
+    """
+    Recorded or synthetic widget inputs, replayed one record per frame so
+    benchmarks of the frame pipeline are reproducible.
 
-        return({
-            'recv': {
-                'bps': recv_bps,
-                'kbps': recv_kbps,
-                'mbps': recv_mbps,
-            },
-            'send': {
-                'bps': sent_bps,
-                'kbps': sent_kbps,
-                'mbps': sent_mbps,
+    Every record holds a system snapshot in the shape SystemSampler takes
+    it, Prometheus query results and a pod count. A Trace stands in for the
+    layout's SystemSampler, TracePrometheus for its Prometheus client.
+    """
+    def __init__(self, records):
+        if not records:
+            raise ValueError("trace has no records")
+
+        self.records = records
+        self.index = 0
+        self.converted = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fd:
+            return(cls([json.loads(line) for line in fd if line.strip()]))
+
+    def save(self, path):
+        with open(path, 'w') as fd:
+            for record in self.records:
+                fd.write(json.dumps(record) + "\n")
+
+    @classmethod
+    def record(cls, sampler, count, interval = 1, prometheus = None, pods = None):
+        """
+        Sample the live system count times, interval seconds apart.
+        With a PrometheusClient every watched query is evaluated for each
+        record, with pods the pod count it returns is recorded as well.
+        """
+        records = []
+        for index in range(count):
+            if index > 0:
+                time.sleep(interval)
+
+            snapshot = sampler.sample()
+            records.append({
+                'system': {
+                    'time': snapshot['time'],
+                    'cpu_percent': snapshot['cpu_percent'],
+                    'cpu_times': snapshot['cpu_times']._asdict(),
+                    'cpu_freq': snapshot['cpu_freq']._asdict() if snapshot['cpu_freq'] else None,
+                    'memory': snapshot['memory']._asdict(),
+                    'loadavg': list(snapshot['loadavg']),
+                    'net': {nic: data._asdict() for nic, data in snapshot['net'].items()},
+                },
+            })
+
+            if prometheus is not None:
+                prometheus.refresh(prometheus.queries())
+                records[-1]['prometheus'] = prometheus.snapshot()
+
+            if pods is not None:
+                records[-1]['pods'] = pods()
+
+        return(cls(records))
+
+    @classmethod
+    def synthetic(cls, count, seed = 0, fps = 10):
+        """
+        Generate count records of plausible, seeded metrics fps apart.
+        """
+        rng = random.Random(seed)
+        total = 16 * 1024 * 1024 * 1024
+        recv = 0
+        sent = 0
+        records = []
+
+        for index in range(count):
+            cpu = 50 + 45 * math.sin(index / 10) * rng.random()
+            used = total * (0.4 + 0.3 * rng.random())
+            recv = recv + int(rng.random() * 5 * 1024 * 1024 / fps)
+            sent = sent + int(rng.random() * 1024 * 1024 / fps)
+
+            records.append({
+                'system': {
+                    'time': index / fps,
+                    'cpu_percent': round(cpu, 1),
+                    'cpu_times': {'iowait': round(rng.random() * 5, 2)},
+                    'cpu_freq': {'current': 800 + rng.random() * 4000, 'min': 800, 'max': 4800},
+                    'memory': {'total': total, 'available': total - used, 'used': used, 'percent': round(used / total * 100, 1)},
+                    'loadavg': [round(rng.random() * 8, 2) for _ in range(3)],
+                    'net': {'eth0': {'bytes_recv': recv, 'bytes_sent': sent}},
+                },
+                'prometheus': {},
+                'metric': rng.randrange(0, 1024 * 1024 * 1024),
+                'pods': rng.randrange(100, 5000),
+            })
+
+        return(cls(records))
+
+    def current(self):
+        return(self.records[self.index % len(self.records)])
+
+    def advance(self):
+        self.index = self.index + 1
+        self.converted = None
+
+    def snapshot(self):
+        """
+        The system snapshot of the current record, as SystemSampler.snapshot()
+        would return it.
+        """
+        if self.converted is None:
+            system = self.current()['system']
+            self.converted = {
+                'time': system['time'],
+                'cpu_percent': system['cpu_percent'],
+                'cpu_times': types.SimpleNamespace(**system['cpu_times']),
+                'cpu_freq': types.SimpleNamespace(**system['cpu_freq']) if system.get('cpu_freq') else None,
+                'memory': types.SimpleNamespace(**system['memory']),
+                'loadavg': tuple(system['loadavg']),
+                'net': {nic: types.SimpleNamespace(**data) for nic, data in system['net'].items()},
             }
-        })
+
+        return(self.converted)
+
+    def pods(self):
+        return(self.current().get('pods', 0))
+
+class TracePrometheus:
+    """
+    Answers Prometheus widgets from a Trace instead of a server, queries
+    missing from the current record get its synthetic metric value.
+    """
+    def __init__(self, trace):
+        self.trace = trace
+
+    def watch(self, query, ttl = None):
+        pass
+
+    def get(self, query, default = None):
+        record = self.trace.current()
+        result = record.get('prometheus', {}).get(query)
+        if result is None:
+            result = [{'metric': {}, 'value': [record['system']['time'], str(record.get('metric', 0))]}]
+
+        return(result)
+
+    def revalidate(self):
+        return(None)
+
+    def stats(self):
+        return({})
+
+    def shutdown(self):
+        pass
+
+class NetworkRates:
+    """
+    Per-interface and aggregate network rates computed from the counters of
+    consecutive SystemSampler snapshots.
+
+    Rates are divided by the monotonic time between the two snapshots
+    rather than the nominal sampling interval, so a late snapshot does not
+    inflate them. An optional EWMA (0 < alpha <= 1, 1 disables it) smooths
+    bursts. Interfaces are filtered with fnmatch patterns, e.g. excluding
+    lo, veth* and cali* keeps local and container traffic out of the total.
+    """
+    def __init__(self, sampler, include = None, exclude = None, alpha = None):
+        self.sampler = sampler
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.alpha = float(alpha) if alpha else 1.0
+        self.previous = None
+        self.rates = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+        if self.alpha <= 0 or self.alpha > 1:
+            raise ValueError("network_ewma_alpha must be within (0, 1]")
+
+    def matches(self, nic):
+        if self.include and not any(fnmatch.fnmatchcase(nic, p) for p in self.include):
+            return(False)
+
+        return(not any(fnmatch.fnmatchcase(nic, p) for p in self.exclude))
+
+    def update(self):
+        snapshot = self.sampler.snapshot()
+
+        with self.lock:
+            if snapshot is self.previous:
+                return
+
+            counters = {
+                nic: (data.bytes_recv, data.bytes_sent)
+                for nic, data in snapshot['net'].items()
+                if self.matches(nic)
+            }
+
+            if self.previous is not None:
+                elapsed = snapshot['time'] - self.previous['time']
+                rates = {}
+                for nic, (recv, sent) in counters.items():
+                    if nic not in self.counters or elapsed <= 0:
+                        continue
+
+                    before_recv, before_sent = self.counters[nic]
+                    # Counters reset when an interface is re-created or wraps
+                    rate = (
+                        max(recv - before_recv, 0) / elapsed,
+                        max(sent - before_sent, 0) / elapsed,
+                    )
+
+                    if nic in self.rates:
+                        last = self.rates[nic]
+                        rate = tuple(
+                            self.alpha * new + (1 - self.alpha) * old
+                            for new, old in zip(rate, last)
+                        )
+
+                    rates[nic] = rate
+
+                self.rates = rates
+
+            self.counters = counters
+            self.previous = snapshot
+
+    def scale(self, recv, sent, digits = None):
+        def units(value):
+            if digits is None:
+                return({'bps': value, 'kbps': value / 1024, 'mbps': value / 1024 / 1024})
+
+            return({
+                'bps': round(value, digits),
+                'kbps': round(value / 1024, digits),
+                'mbps': round(value / 1024 / 1024, digits),
+            })
+
+        return({'recv': units(recv), 'send': units(sent)})
+
+    def sum(self, values, nic):
+        if nic is not None:
+            return(values.get(nic))
+
+        if not values:
+            return(None)
+
+        return((
+            sum(value[0] for value in values.values()),
+            sum(value[1] for value in values.values()),
+        ))
+
+    def throughput(self, nic = None):
+        """
+        Bytes per second of one interface, or of all matching interfaces
+        when nic is None. Returns False until two snapshots were taken.
+        """
+        self.update()
+
+        with self.lock:
+            rate = self.sum(self.rates, nic)
+
+        if rate is None:
+            return(False)
+
+        return(self.scale(rate[0], rate[1], 2))
+
+    def total(self, nic = None):
+        """
+        Bytes transferred since boot by one interface, or by all matching
+        interfaces when nic is None.
+        """
+        self.update()
+
+        with self.lock:
+            count = self.sum(self.counters, nic)
+
+        if count is None:
+            return(False)
+
+        return(self.scale(count[0], count[1]))
@@ -3,30 +3,41 @@ import ast
 import math
 import time
 import datetime
-import psutil
 import uptime
 import kubernetes
-import prometheus_api_client as prom
 
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import ImageDraw, ImageColor
 
 import util
 
-IMAGE_PATH = None
-
 WIDGET_TYPE_TEXT = 10
 WIDGET_TYPE_BAR = 20
 
 ORIENTATION_VERTICAL = 10
 ORIENTATION_HORIZONTAL = 20
 
-CPU_LAST_POLL = 0
-CPU_LAST_VALUE = 0
+# Shared by every text widget of the process
+FONT_CACHE = util.FontCache()
 
 class Widget:
+    # Seconds between two tick() calls, 0 ticks on every frame.
+    # Overridden per widget by the <widget>_interval configuration.
+    INTERVAL = 0
+
     def __init__(self, config, tmpdir, logger):
         self.config = config
         self.value = None
+        self.interval = self.INTERVAL
+        self.last_tick = None
+        self.collector = None
+        self.sampler = None
+        self.network = None
+        self.interface = None
+        self.prometheus = None
+        self.remote = False
+        self.remote_key = None
+        self.promql = None
+        self.last_version = None
         self.node = None
         self.tmpdir = tmpdir
         self.logger = logger
@@ -35,6 +46,8 @@ class Widget:
         self.y = 0
         self.font_file = None
         self.font_size = 14
+        self.font_index = 0
+        self.font = None
         self.font_color = (255, 255, 255)
         self.line_length = 0
         self.line_space = 0
@@ -48,19 +61,54 @@ class Widget:
         self.widget_type = 0
         self.prometheus_url = None
         self.prometheus_url_disable_ssl = True
+        self.tick_time = util.METRICS.histogram('ttlcd_widget_tick_seconds', 'Time a widget spent refreshing its value', {'widget': self.__class__.__name__}, util.Histogram.FAST_BUCKETS)
+        self.draw_time = util.METRICS.histogram('ttlcd_widget_draw_seconds', 'Time a widget spent drawing onto the frame', {'widget': self.__class__.__name__}, util.Histogram.FAST_BUCKETS)
 
 
     def tick(self):
         """ Override this function """
         pass
 
+    def update(self, now = None):
+        """
+        Call tick() once our refresh interval has elapsed, otherwise keep
+        the cached value.  Returns True if the value was refreshed.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if self.remote:
+            # Remote values refresh whenever the collector published a new result
+            version = self.collector.version(self.remote_key)
+            if version is None or version == self.last_version:
+                return(False)
+            self.last_version = version
+        elif self.last_tick is not None and now - self.last_tick < self.interval and not self.stale():
+            return(False)
+
+        started = time.perf_counter()
+        self.tick()
+        self.tick_time.observe(time.perf_counter() - started)
+
+        # Keep ticking on the original phase, frame jitter must not shift
+        # it, unless we fell more than a whole interval behind
+        if self.last_tick is None or now - self.last_tick >= 2 * self.interval:
+            self.last_tick = now
+        else:
+            self.last_tick = self.last_tick + self.interval
+
+        return(True)
+
+    def stale(self):
+        """
+        Override me to refresh before the interval elapsed, i.e. when the
+        value shown is known to be outdated.
+        """
+        return(False)
+
     def get(self):
         return(self.value)
 
-    def set_image_path(self, path):
-        global IMAGE_PATH
-        IMAGE_PATH = path
-
     def set_background(self, background_file = None):
         if background_file is None:
             self.background_file = self.config.get('background')
@@ -89,6 +137,22 @@ class Widget:
         else:
             self.font_size = self.config.get('font_size')
 
+    def set_font_index(self, font_index = None):
+        if font_index is not None:
+            self.font_index = font_index
+        else:
+            self.font_index = 0
+
+    def load_font(self):
+        """
+        Fetch our font from the shared font cache, parsing it only if
+        no other widget has loaded the same font, size and index yet.
+        """
+        if self.widget_type == WIDGET_TYPE_TEXT:
+            self.font = FONT_CACHE.get(self.get_font(), self.get_font_size(), self.get_font_index())
+
+        return(self.font)
+
     def set_font_color(self, font_color = None):
         if font_color is not None:
             self.font_color = font_color
@@ -113,6 +177,57 @@ class Widget:
         else:
             self.line_space = self.config.get('line_space')
 
+    def set_collector(self, collector):
+        self.collector = collector
+
+    def set_sampler(self, sampler):
+        self.sampler = sampler
+
+    def set_network(self, network):
+        self.network = network
+
+    def set_interface(self, interface):
+        """
+        Restrict a network widget to one interface, None sums all
+        interfaces accepted by the network rate engine.
+        """
+        self.interface = interface
+
+    def get_interface(self):
+        return(self.interface)
+
+    def set_prometheus(self, prometheus):
+        self.prometheus = prometheus
+
+    def collect(self, fetch):
+        """
+        Run the blocking fetch on the background collector once per
+        interval, tick() then reads the latest result with collected().
+        """
+        self.remote = True
+        self.remote_key = self.get_name()
+        self.collector.register(self.remote_key, fetch, self.interval)
+
+    def query(self, query, ttl = None):
+        """
+        Read the PromQL query from the layout's shared Prometheus cache,
+        tick() then gets the latest result with collected() without ever
+        waiting on Prometheus.  Results are re-queried after ttl seconds.
+        """
+        self.promql = query
+        self.prometheus.watch(query, ttl)
+
+    def collected(self, default = None):
+        if self.promql is not None:
+            return(self.prometheus.get(self.promql, default))
+        return(self.collector.get(self.remote_key, default))
+
+    def set_interval(self, interval = None):
+        if interval is not None:
+            self.interval = float(interval)
+        else:
+            self.interval = self.INTERVAL
+
     def set_x(self, x = None):
         if x is not None:
             self.x = x
@@ -158,9 +273,11 @@ class Widget:
     def get_background(self):
         return(self.background_file)
 
-    def get_image_path(self):
-        global IMAGE_PATH
-        return(IMAGE_PATH)
+    def get_name(self):
+        return(self.__class__.__name__)
+
+    def get_interval(self):
+        return(self.interval)
 
     def get_x(self):
         return(self.x)
@@ -177,6 +294,9 @@ class Widget:
     def get_font_size(self):
         return(self.font_size)
 
+    def get_font_index(self):
+        return(self.font_index)
+
     def get_font_color(self):
         return(self.font_color)
     
@@ -186,29 +306,21 @@ class Widget:
     def get_line_space(self):
         return(self.line_space)
 
-    def clear(self):
-        global IMAGE_PATH
-        if IMAGE_PATH is not None and os.path.exists(IMAGE_PATH):
-            os.remove(IMAGE_PATH)
-            IMAGE_PATH = None
-
-    def draw(self):
-        self.tick()
-
-        if self.get_image_path() is None and self.get_background() is not None:
-            image = Image.open(self.get_background())
-            self.set_image_path(os.path.join(self.tmpdir.name, 'screen.jpg'))
-        else:
-            try:
-                image = Image.open(self.get_image_path())
-            except Exception as e:
-                self.logger.error("failed to open image %s", str(e))
-                return(False)
+    def draw(self, canvas):
+        """
+        Draw onto the frame canvas shared by all widgets of a layout.
+        The layout has already called tick() for this frame.
+        """
+        # Nothing to show until a first value arrived
+        if self.value is None:
+            return
 
-        draw = ImageDraw.Draw(image)
+        draw = ImageDraw.Draw(canvas)
 
         if self.widget_type == WIDGET_TYPE_TEXT:
-            f = ImageFont.truetype(self.get_font(), self.get_font_size())
+            f = self.font
+            if f is None:
+                f = self.load_font()
 
             # Where to place us on the screen
             loc = self.get_location()
@@ -314,8 +426,6 @@ class Widget:
                     return(False)
 
                 bar_index = bar_index + 1
-
-        image.save(self.get_image_path(), "JPEG", progressive = False, quality = 80, optimize = True)
     
     def get_tmpdir(self):
         return(self.tmpdir)
@@ -339,14 +449,18 @@ class Text(Widget):
         self.set_background(background)
         self.set_x(self.config.get('x'))
         self.set_y(self.config.get('y'))
+        self.set_interval(self.config.get('interval'))
         self.set_font(self.config.get('font_file'))
         self.set_font_size(self.config.get('font_size'))
+        self.set_font_index(self.config.get('font_index'))
         self.set_font_color(self.config.get('font_color'))
 
     def tick(self):
         self.value = self.config.get('string')
 
 class Date(Widget):
+    INTERVAL = 60
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -355,14 +469,24 @@ class Date(Widget):
         self.set_background(background)
         self.set_x(self.config.get('date_x'))
         self.set_y(self.config.get('date_y'))
+        self.set_interval(self.config.get('date_interval'))
         self.set_font(self.config.get('date_font_file'))
         self.set_font_size(self.config.get('date_font_size'))
         self.set_font_color(self.config.get('date_font_color'))
 
+    def format(self):
+        return(str(datetime.datetime.now()).split(" ")[0])
+
+    def stale(self):
+        # Roll over at midnight, not up to an interval later
+        return(self.value != self.format())
+
     def tick(self):
-        self.value = str(datetime.datetime.now()).split(" ")[0]
+        self.value = self.format()
 
 class Time(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -371,14 +495,24 @@ class Time(Widget):
         self.set_background(background)
         self.set_x(self.config.get('time_x'))
         self.set_y(self.config.get('time_y'))
+        self.set_interval(self.config.get('time_interval'))
         self.set_font(self.config.get('time_font_file'))
         self.set_font_size(self.config.get('time_font_size'))
         self.set_font_color(self.config.get('time_font_color'))
 
+    def format(self):
+        return(str(datetime.datetime.now()).split(" ")[1].split(".")[0])
+
+    def stale(self):
+        # Follow the wall clock second, frames are not aligned to it
+        return(self.value != self.format())
+
     def tick(self):
-        self.value = str(datetime.datetime.now()).split(" ")[1].split(".")[0]
+        self.value = self.format()
 
 class CpuUtilization(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         Widget.__init__(self, config, tmpdir, logger)
 
@@ -387,23 +521,17 @@ class CpuUtilization(Widget):
         self.set_background(background)
         self.set_x(self.config.get('cpu_utilization_x'))
         self.set_y(self.config.get('cpu_utilization_y'))
+        self.set_interval(self.config.get('cpu_utilization_interval'))
         self.set_font(self.config.get('cpu_utilization_font_file'))
         self.set_font_size(self.config.get('cpu_utilization_font_size'))
         self.set_font_color(self.config.get('cpu_utilization_font_color'))
 
     def tick(self):
-        global CPU_LAST_POLL, CPU_LAST_VALUE
-
-        now = time.time()
-
-        if now - CPU_LAST_POLL >= 1:
-            self.value = str(psutil.cpu_percent()).rjust(5, ' ')
-            CPU_LAST_POLL = now
-            CPU_LAST_VALUE = self.value
-        else:
-            self.value = str(CPU_LAST_VALUE).rjust(5, ' ')
+        self.value = str(self.sampler.snapshot()['cpu_percent']).rjust(5, ' ')
 
 class CpuUtilizationBar(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -424,6 +552,7 @@ class CpuUtilizationBar(Widget):
 
         self.set_x(self.config.get('cpu_utilization_bar_x'))
         self.set_y(self.config.get('cpu_utilization_bar_y'))
+        self.set_interval(self.config.get('cpu_utilization_bar_interval'))
         self.set_bar_width(self.config.get('cpu_utilization_bar_width'))
         self.set_bar_height(self.config.get('cpu_utilization_bar_height'))
         self.set_bar_scale(self.config.get('cpu_utilization_bar_scale'))
@@ -431,18 +560,11 @@ class CpuUtilizationBar(Widget):
         self.set_bar_outline_color(self.config.get('cpu_utilization_bar_outline_color', 'red'))
 
     def tick(self):
-        global CPU_LAST_POLL, CPU_LAST_VALUE
-
-        now = time.time()
-
-        if now - CPU_LAST_POLL >= 1:
-            self.value = psutil.cpu_percent()
-            CPU_LAST_POLL = now
-            CPU_LAST_VALUE = self.value
-        else:
-            self.value = CPU_LAST_VALUE
+        self.value = self.sampler.snapshot()['cpu_percent']
 
 class RamAvailable(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -451,15 +573,18 @@ class RamAvailable(Widget):
         self.set_background(background)
         self.set_x(self.config.get('ram_available_x'))
         self.set_y(self.config.get('ram_available_y'))
+        self.set_interval(self.config.get('ram_available_interval'))
         self.set_font(self.config.get('ram_available_font_file'))
         self.set_font_size(self.config.get('ram_available_font_size'))
         self.set_font_color(self.config.get('ram_available_font_color'))
 
     def tick(self):
-        mem = psutil.virtual_memory()
+        mem = self.sampler.snapshot()['memory']
         self.value = "{}%".format(str(round(mem.available / mem.total * 100, 1)).rjust(3, ' '))
 
 class RamUtilization(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -468,15 +593,18 @@ class RamUtilization(Widget):
         self.set_background(background)
         self.set_x(self.config.get('ram_utilization_x'))
         self.set_y(self.config.get('ram_utilization_y'))
+        self.set_interval(self.config.get('ram_utilization_interval'))
         self.set_font(self.config.get('ram_utilization_font_file'))
         self.set_font_size(self.config.get('ram_utilization_font_size'))
         self.set_font_color(self.config.get('ram_utilization_font_color'))
 
     def tick(self):
-        mem = psutil.virtual_memory()
+        mem = self.sampler.snapshot()['memory']
         self.value = "{}%".format(str(round(mem.used / mem.total * 100, 1)).rjust(3, ' '))
 
 class RamUtilizationBar(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         super().__init__(config, tmpdir, logger)
 
@@ -497,6 +625,7 @@ class RamUtilizationBar(Widget):
         
         self.set_x(self.config.get('ram_utilization_bar_x'))
         self.set_y(self.config.get('ram_utilization_bar_y'))
+        self.set_interval(self.config.get('ram_utilization_bar_interval'))
         self.set_bar_width(self.config.get('ram_utilization_bar_width'))
         self.set_bar_height(self.config.get('ram_utilization_bar_height'))
         self.set_bar_scale(self.config.get('ram_utilization_bar_scale'))
@@ -504,9 +633,11 @@ class RamUtilizationBar(Widget):
         self.set_bar_outline_color(self.config.get('ram_utilization_bar_outline_color', 'red'))
 
     def tick(self):
-        self.value = psutil.virtual_memory().percent
+        self.value = self.sampler.snapshot()['memory'].percent
 
 class LoadAverage(Widget):
+    INTERVAL = 5
+
     def __init__(self, config, tmpdir, logger):
         Widget.__init__(self, config, tmpdir, logger)
 
@@ -515,15 +646,18 @@ class LoadAverage(Widget):
         self.set_background(background)
         self.set_x(self.config.get('loadavg_x'))
         self.set_y(self.config.get('loadavg_y'))
+        self.set_interval(self.config.get('loadavg_interval'))
         self.set_font(self.config.get('loadavg_font_file'))
         self.set_font_size(self.config.get('loadavg_font_size'))
         self.set_font_color(self.config.get('loadavg_font_color'))
 
     def tick(self):
-        self.value = psutil.getloadavg()
+        self.value = self.sampler.snapshot()['loadavg']
         self.value = str(round(self.value[0], 2)).rjust(5, ' ')
 
 class IOWait(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         Widget.__init__(self, config, tmpdir, logger)
 
@@ -532,17 +666,19 @@ class IOWait(Widget):
         self.set_background(background)
         self.set_x(self.config.get('iowait_x'))
         self.set_y(self.config.get('iowait_y'))
+        self.set_interval(self.config.get('iowait_interval'))
         self.set_font(self.config.get('iowait_font_file'))
         self.set_font_size(self.config.get('iowait_font_size'))
         self.set_font_color(self.config.get('iowait_font_color'))
 
     def tick(self):
-        self.value = psutil.cpu_times().iowait
+        self.value = self.sampler.snapshot()['cpu_times'].iowait
         self.value = str(round(self.value, 2)).rjust(5, ' ')
 
 class NetworkThroughputSend(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
-        self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
 
     def setup(self, background):
@@ -550,16 +686,14 @@ class NetworkThroughputSend(Widget):
         self.set_background(background)
         self.set_x(self.config.get('network_throughput_send_x'))
         self.set_y(self.config.get('network_throughput_send_y'))
+        self.set_interval(self.config.get('network_throughput_send_interval'))
+        self.set_interface(self.config.get('network_throughput_send_interface'))
         self.set_font(self.config.get('network_throughput_send_font_file'))
         self.set_font_size(self.config.get('network_throughput_send_font_size'))
         self.set_font_color(self.config.get('network_throughput_send_font_color'))
 
     def tick(self):
-        if not self.net_send:
-            self.net_send = util.NetworkStatistics(util.NETWORK_THROUGHPUT)
-            self.net_send.start()
-
-        tp = self.net_send.poll_throughput()
+        tp = self.network.throughput(self.interface)
         if tp is not False:
             if tp['send']['bps'] < 1024:
                 self.value = "{} B/s".format("%.2f" % tp['send']['kbps'],)
@@ -570,13 +704,10 @@ class NetworkThroughputSend(Widget):
         else:
             self.value = "0 B/s"
 
-    def shutdown(self):
-        if self.net_send:
-            self.net_send.shutdown()
-        
 class NetworkThroughputRecv(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
-        self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
 
     def setup(self, background):
@@ -584,16 +715,14 @@ class NetworkThroughputRecv(Widget):
         self.set_background(background)
         self.set_x(self.config.get('network_throughput_recv_x'))
         self.set_y(self.config.get('network_throughput_recv_y'))
+        self.set_interval(self.config.get('network_throughput_recv_interval'))
+        self.set_interface(self.config.get('network_throughput_recv_interface'))
         self.set_font(self.config.get('network_throughput_recv_font_file'))
         self.set_font_size(self.config.get('network_throughput_recv_font_size'))
         self.set_font_color(self.config.get('network_throughput_recv_font_color'))
 
     def tick(self):
-        if not self.net_send:
-            self.net_send = util.NetworkStatistics(util.NETWORK_THROUGHPUT)
-            self.net_send.start()
-
-        tp = self.net_send.poll_throughput()
+        tp = self.network.throughput(self.interface)
 
         if tp is not False:
             if tp['recv']['bps'] < 1024:
@@ -604,15 +733,11 @@ class NetworkThroughputRecv(Widget):
                 self.value = "{} MB/s".format("%.2f" % tp['recv']['mbps'],)
         else:
             self.value = "0 B/s"
-    
-    def shutdown(self):
-        if self.net_send:
-            self.net_send.shutdown()
 
-        
 class NetworkThroughputRecvTotal(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
-        self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
 
     def setup(self, background):
@@ -620,16 +745,14 @@ class NetworkThroughputRecvTotal(Widget):
         self.set_background(background)
         self.set_x(self.config.get('network_throughput_recv_total_x'))
         self.set_y(self.config.get('network_throughput_recv_total_y'))
+        self.set_interval(self.config.get('network_throughput_recv_total_interval'))
+        self.set_interface(self.config.get('network_throughput_recv_total_interface'))
         self.set_font(self.config.get('network_throughput_recv_total_font_file'))
         self.set_font_size(self.config.get('network_throughput_recv_total_font_size'))
         self.set_font_color(self.config.get('network_throughput_recv_total_font_color'))
 
     def tick(self):
-        if not self.net_send:
-            self.net_send = util.NetworkStatistics(util.NETWORK_TOTAL)
-            self.net_send.start()
-
-        tp = self.net_send.poll_total()
+        tp = self.network.total(self.interface)
 
         if tp is not False:
             if tp['recv']['bps'] < 1024:
@@ -641,13 +764,10 @@ class NetworkThroughputRecvTotal(Widget):
         else:
             self.value = "0 B/s"
 
-    def shutdown(self):
-        if self.net_send:
-            self.net_send.shutdown()
-
 class NetworkThroughputSendTotal(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
-        self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
 
     def setup(self, background):
@@ -655,16 +775,14 @@ class NetworkThroughputSendTotal(Widget):
         self.set_background(background)
         self.set_x(self.config.get('network_throughput_send_total_x'))
         self.set_y(self.config.get('network_throughput_send_total_y'))
+        self.set_interval(self.config.get('network_throughput_send_total_interval'))
+        self.set_interface(self.config.get('network_throughput_send_total_interface'))
         self.set_font(self.config.get('network_throughput_send_total_font_file'))
         self.set_font_size(self.config.get('network_throughput_send_total_font_size'))
         self.set_font_color(self.config.get('network_throughput_send_total_font_color'))
 
     def tick(self):
-        if not self.net_send:
-            self.net_send = util.NetworkStatistics(util.NETWORK_TOTAL)
-            self.net_send.start()
-
-        tp = self.net_send.poll_total()
+        tp = self.network.total(self.interface)
 
         if tp is not False:
             if tp['send']['bps'] < 1024:
@@ -676,11 +794,9 @@ class NetworkThroughputSendTotal(Widget):
         else:
             self.value = "0 B/s"
 
-    def shutdown(self):
-        if self.net_send:
-            self.net_send.shutdown()
-
 class CpuFreq(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         Widget.__init__(self, config, tmpdir, logger)
 
@@ -689,15 +805,22 @@ class CpuFreq(Widget):
         self.set_background(background)
         self.set_x(self.config.get('cpufreq_x'))
         self.set_y(self.config.get('cpufreq_y'))
+        self.set_interval(self.config.get('cpufreq_interval'))
         self.set_font(self.config.get('cpufreq_font_file'))
         self.set_font_size(self.config.get('cpufreq_font_size'))
         self.set_font_color(self.config.get('cpufreq_font_color'))
 
     def tick(self):
-        self.value = psutil.cpu_freq().current
+        freq = self.sampler.snapshot()['cpu_freq']
+        if freq is not None:
+            self.value = freq.current
+        else:
+            self.value = 0
         self.value = "{} MHz".format(str(int(self.value)).rjust(5, ' '))
 
 class Uptime(Widget):
+    INTERVAL = 60
+
     def __init__(self, config, tmpdir, logger):
         Widget.__init__(self, config, tmpdir, logger)
 
@@ -706,6 +829,7 @@ class Uptime(Widget):
         self.set_background(background)
         self.set_x(self.config.get('uptime_x'))
         self.set_y(self.config.get('uptime_y'))
+        self.set_interval(self.config.get('uptime_interval'))
         self.set_font(self.config.get('uptime_font_file'))
         self.set_font_size(self.config.get('uptime_font_size'))
         self.set_font_color(self.config.get('uptime_font_color'))
@@ -718,30 +842,69 @@ class Uptime(Widget):
             self.value = "0 days".center(10, ' ')
 
 class KubernetesPodCount(Widget):
+    INTERVAL = 10
+
     def __init__(self, config, tmpdir, logger):
+        self.informer = None
         Widget.__init__(self, config, tmpdir, logger)
 
     def setup(self, background):
-        kubernetes.config.load_kube_config()
-        self.client = kubernetes.client.CoreV1Api()
-        self.network_client = kubernetes.client.NetworkingV1Api()
-
         self.set_type(WIDGET_TYPE_TEXT)
         self.set_background(background)
         self.set_x(self.config.get('kubernetes_pod_count_x'))
         self.set_y(self.config.get('kubernetes_pod_count_y'))
+        self.set_interval(self.config.get('kubernetes_pod_count_interval'))
         self.set_font(self.config.get('kubernetes_pod_count_font_file'))
         self.set_font_size(self.config.get('kubernetes_pod_count_font_size'))
         self.set_font_color(self.config.get('kubernetes_pod_count_font_color'))
 
+        # Selectors are evaluated by the API server, $NODE_NAME and
+        # friends are expanded to count e.g. only this node's pods
+        self.field_selector = os.path.expandvars(self.config.get('kubernetes_pod_count_field_selector', ''))
+        self.label_selector = os.path.expandvars(self.config.get('kubernetes_pod_count_label_selector', ''))
+        self.page_size = self.config.get('kubernetes_pod_count_page_size', 500)
+
+        mode = self.config.get('kubernetes_pod_count_mode', 'watch')
+        if mode == 'replay':
+            # Counts are published into the collector by a trace replay
+            self.remote = True
+            self.remote_key = self.get_name()
+            return
+
+        kubernetes.config.load_kube_config()
+        self.client = kubernetes.client.CoreV1Api()
+        self.network_client = kubernetes.client.NetworkingV1Api()
+
+        # watch keeps a local pod index current, list polls every interval
+        if mode == 'watch':
+            self.remote = True
+            self.remote_key = self.get_name()
+            self.informer = util.PodInformer(self.client, self.collector, self.remote_key, self.logger, self.field_selector, self.label_selector, self.page_size)
+            self.informer.start()
+        else:
+            self.collect(self.fetch)
+
+    def fetch(self):
+        pods, resource_version = util.list_pods(self.client, self.field_selector, self.label_selector, self.page_size)
+        return(len(pods))
+
+    def shutdown(self):
+        if self.informer is not None:
+            self.informer.shutdown()
+
     def tick(self):
-        r = self.client.list_pod_for_all_namespaces(watch=False)
-        if len(r.items) < 10:
-            self.value = " " + str(len(r.items)).center(3, ' ')
+        count = self.collected()
+        if count is None:
+            return
+
+        if count < 10:
+            self.value = " " + str(count).center(3, ' ')
         else:
-            self.value = str(len(r.items)).center(3, ' ')
+            self.value = str(count).center(3, ' ')
 
 class PrometheusNetworkThroughputRecv(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -751,16 +914,18 @@ class PrometheusNetworkThroughputRecv(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_network_throughput_recv_x'))
         self.set_y(self.config.get('prometheus_network_throughput_recv_y'))
+        self.set_interval(self.config.get('prometheus_network_throughput_recv_interval'))
         self.set_font(self.config.get('prometheus_network_throughput_recv_font_file'))
         self.set_font_size(self.config.get('prometheus_network_throughput_recv_font_size'))
         self.set_font_color(self.config.get('prometheus_network_throughput_recv_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('irate(node_network_receive_bytes_total[1m])', self.config.get('prometheus_network_throughput_recv_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query(query = 'irate(node_network_receive_bytes_total[1m])')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         if metrics:
             total = 0
             for m in metrics:
@@ -777,6 +942,8 @@ class PrometheusNetworkThroughputRecv(Widget):
         
 
 class PrometheusNetworkThroughputSend(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -786,16 +953,18 @@ class PrometheusNetworkThroughputSend(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_network_throughput_send_x'))
         self.set_y(self.config.get('prometheus_network_throughput_send_y'))
+        self.set_interval(self.config.get('prometheus_network_throughput_send_interval'))
         self.set_font(self.config.get('prometheus_network_throughput_send_font_file'))
         self.set_font_size(self.config.get('prometheus_network_throughput_send_font_size'))
         self.set_font_color(self.config.get('prometheus_network_throughput_send_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('irate(node_network_transmit_bytes_total[1m])', self.config.get('prometheus_network_throughput_send_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query(query = 'irate(node_network_transmit_bytes_total[1m])')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         if metrics:
             total = 0
             for m in metrics:
@@ -811,6 +980,8 @@ class PrometheusNetworkThroughputSend(Widget):
             self.value = "0 B/s"
         
 class PrometheusOutOfMemory(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -820,22 +991,26 @@ class PrometheusOutOfMemory(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_oom_x'))
         self.set_y(self.config.get('prometheus_oom_y'))
+        self.set_interval(self.config.get('prometheus_oom_interval'))
         self.set_font(self.config.get('prometheus_oom_font_file'))
         self.set_font_size(self.config.get('prometheus_oom_font_size'))
         self.set_font_color(self.config.get('prometheus_oom_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('sum by (namespace, pod) (kube_pod_container_status_restarts_total) * on(namespace, pod) group_left(reason) kube_pod_container_status_last_terminated_reason{reason="OOMKilled"}', self.config.get('prometheus_oom_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query(query = 'sum by (namespace, pod) (kube_pod_container_status_restarts_total) * on(namespace, pod) group_left(reason) kube_pod_container_status_last_terminated_reason{reason="OOMKilled"}')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         self.value = 0
         for metric in metrics:
             self.value = self.value + int(metric['value'][1])
         self.value = str(self.value).rjust(4, ' ')[0:4]
 
 class PrometheusFreeNodeMemory(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -845,16 +1020,18 @@ class PrometheusFreeNodeMemory(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_free_node_memory_x'))
         self.set_y(self.config.get('prometheus_free_node_memory_y'))
+        self.set_interval(self.config.get('prometheus_free_node_memory_interval'))
         self.set_font(self.config.get('prometheus_free_node_memory_font_file'))
         self.set_font_size(self.config.get('prometheus_free_node_memory_font_size'))
         self.set_font_color(self.config.get('prometheus_free_node_memory_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('sum(node_memory_MemFree_bytes)', self.config.get('prometheus_free_node_memory_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query('sum(node_memory_MemFree_bytes)')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         self.value = 0
         for metric in metrics:
             self.value = self.value + int(metric['value'][1])
@@ -872,6 +1049,8 @@ class PrometheusFreeNodeMemory(Widget):
         self.value = str(self.value).rjust(4, ' ')
 
 class PrometheusFreeCpuPercent(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -881,21 +1060,25 @@ class PrometheusFreeCpuPercent(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_free_cpu_percent_x'))
         self.set_y(self.config.get('prometheus_free_cpu_percent_y'))
+        self.set_interval(self.config.get('prometheus_free_cpu_percent_interval'))
         self.set_font(self.config.get('prometheus_free_cpu_percent_font_file'))
         self.set_font_size(self.config.get('prometheus_free_cpu_percent_font_size'))
         self.set_font_color(self.config.get('prometheus_free_cpu_percent_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('sum(100 - (100 * avg(1 - rate(node_cpu_seconds_total{mode="idle"}[1m])) by (instance)))/count(100 - (100 * avg(1 - rate(node_cpu_seconds_total{mode="idle"}[1m])) by (instance)))', self.config.get('prometheus_free_cpu_percent_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query(query = 'sum(100 - (100 * avg(1 - rate(node_cpu_seconds_total{mode="idle"}[1m])) by (instance)))/count(100 - (100 * avg(1 - rate(node_cpu_seconds_total{mode="idle"}[1m])) by (instance)))')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         # There is only 1 metric
         for metric in metrics:
             self.value = str("{:d}%".format(int(metric['value'][1].split('.')[0]))).rjust(4, ' ')[0:4]
 
 class PrometheusClusterDiskThroughput(Widget):
+    INTERVAL = 1
+
     def __init__(self, config, tmpdir, logger):
         self.net_send = False
         Widget.__init__(self, config, tmpdir, logger)
@@ -905,16 +1088,18 @@ class PrometheusClusterDiskThroughput(Widget):
         self.set_background(background)
         self.set_x(self.config.get('prometheus_cluster_disk_throughput_x'))
         self.set_y(self.config.get('prometheus_cluster_disk_throughput_y'))
+        self.set_interval(self.config.get('prometheus_cluster_disk_throughput_interval'))
         self.set_font(self.config.get('prometheus_cluster_disk_throughput_font_file'))
         self.set_font_size(self.config.get('prometheus_cluster_disk_throughput_font_size'))
         self.set_font_color(self.config.get('prometheus_cluster_disk_throughput_font_color'))
-        self.set_prometheus_url(self.config.get('prometheus_url'))
-        self.set_prometheus_url_disable_ssl(self.config.get('prometheus_url_disable_ssl'))
 
-        self.pclient = prom.PrometheusConnect(url = self.prometheus_url, disable_ssl=self.prometheus_url_disable_ssl)
+        self.query('sum(sum by (device) (rate(container_fs_writes_bytes_total[1m]))) + (sum by (device) (rate(container_fs_reads_bytes_total[1m])))', self.config.get('prometheus_cluster_disk_throughput_ttl'))
 
     def tick(self):
-        metrics = self.pclient.custom_query('sum(sum by (device) (rate(container_fs_writes_bytes_total[1m]))) + (sum by (device) (rate(container_fs_reads_bytes_total[1m])))')
+        metrics = self.collected()
+        if metrics is None:
+            return
+
         self.value = 0
         for metric in metrics:
             self.value = self.value + int(metric['value'][1].split('.')[0])